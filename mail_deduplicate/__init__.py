@@ -17,12 +17,13 @@
 
 """ Expose package-wide elements. """
 
+import hashlib
 import logging
 import sys
+from functools import partial
 from operator import methodcaller
 from pathlib import Path
 
-from boltons.ecoutils import get_profile
 from boltons.iterutils import unique
 
 # Canonical name of the CLI.
@@ -31,10 +32,6 @@ CLI_NAME = "mdedup"
 __version__ = "6.1.4"
 
 
-# Environment data.
-env_data = get_profile(scrub=True)
-
-
 # Initialize global logger.
 logger = logging.getLogger(CLI_NAME)
 
@@ -66,6 +63,19 @@ HASH_HEADERS = (
 )
 
 
+# Hash algorithms available to compute the canonical hash of a mail from its
+# headers. SHA-224 is the historical default. Others are faster alternatives
+# available in the standard library, with shorter digests.
+DEFAULT_HASH_ALGORITHM = "sha224"
+HASH_ALGORITHMS = {
+    "sha224": hashlib.sha224,
+    "sha256": hashlib.sha256,
+    "sha1": hashlib.sha1,
+    "blake2b-128": partial(hashlib.blake2b, digest_size=16),
+    "blake2s-128": partial(hashlib.blake2s, digest_size=16),
+}
+
+
 # Below this value, we consider not having enough data to compute a solid hash.
 MINIMAL_HEADERS_COUNT = 4
 
@@ -121,6 +131,7 @@ class Config:
         "force_unlock": False,
         "hash_only": False,
         "hash_headers": HASH_HEADERS,
+        "hash_algorithm": DEFAULT_HASH_ALGORITHM,
         "size_threshold": DEFAULT_SIZE_THRESHOLD,
         "content_threshold": DEFAULT_CONTENT_THRESHOLD,
         "show_diff": False,
@@ -130,6 +141,13 @@ class Config:
         "action": None,
         "export": None,
         "export_format": "mbox",
+        "stream": False,
+        "jobs": 1,
+        "prefetch": 0,
+        "header_only": False,
+        "index": None,
+        "events": None,
+        "profile": None,
     }
 
     def __init__(self, **kwargs):
@@ -148,6 +166,13 @@ class Config:
         assert self.size_threshold >= -1
         assert self.content_threshold >= -1
 
+        # Check parallelism.
+        assert self.jobs >= 1
+        assert self.prefetch >= 0
+
+        # Check hash algorithm.
+        assert self.hash_algorithm in HASH_ALGORITHMS
+
         # Headers are case-insensitive in Python implementation.
         normalized_headers = [h.lower() for h in self.hash_headers]
         # Remove duplicate entries.
@@ -168,6 +193,12 @@ class Config:
                 raise FileExistsError(self.export)
 
     def __getattr__(self, attr_id):
-        """ Expose configuration entries as properties. """
-        if attr_id in self.conf:
-            return self.conf[attr_id]
+        """Expose configuration entries as properties.
+
+        Lookups are made against the instance dictionary directly, so this object can
+        be pickled and sent to worker processes.
+        """
+        conf = self.__dict__.get("conf", {})
+        if attr_id in conf:
+            return conf[attr_id]
+        raise AttributeError(attr_id)
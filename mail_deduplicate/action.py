@@ -15,12 +15,15 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
+from collections import OrderedDict
+from functools import partial
+
 from boltons.iterutils import unique
 from boltons.dictutils import FrozenDict
 
 from . import logger
 from .colorize import choice_style
-from .mailbox import create_box
+from .mailbox import BatchWriter, create_box, remove_batch
 
 
 # Actions performed on the mail selection.
@@ -31,52 +34,106 @@ MOVE_DISCARDED = "move-discarded"
 DELETE_SELECTED = "delete-selected"
 DELETE_DISCARDED = "delete-discarded"
 
+# Number of mails removed at once from their sources.
+REMOVAL_BATCH_SIZE = 1024
+
 
-def copy_selected(dedup):
+def copy_selected(dedup, selection):
     """Copy all mails selected to a brand new box."""
-    box = create_box(dedup.conf.export, dedup.conf.export_format)
+    box = None
 
-    for mail in dedup.selection:
+    for mail in selection:
+        # Create the box on the first mail, as the selection might be streamed.
+        if box is None:
+            box = BatchWriter(create_box(dedup.conf.export, dedup.conf.export_format))
         logger.debug(f"Copying {mail!r} to {dedup.conf.export}...")
         dedup.stats["mail_copied"] += 1
         if dedup.conf.dry_run:
             logger.warning("DRY RUN: Skip action.")
         else:
-            box.add(mail)
+            box.add_mail(mail)
             logger.info(f"{mail!r} copied.")
 
-    logger.debug(f"Close {dedup.conf.export}")
-    box.close()
+    if box is not None:
+        logger.debug(f"Close {dedup.conf.export}")
+        box.close()
 
 
-def move_selected(dedup):
-    """Move all mails selected to a brand new box."""
-    box = create_box(dedup.conf.export, dedup.conf.export_format)
+def move_selected(dedup, selection):
+    """Move all mails selected to a brand new box.
 
-    for mail in dedup.selection:
+    Mails are only removed from their sources once written to the new box. Removals
+    are grouped by source and applied by batches.
+    """
+    box = None
+    removals = Removals(dedup)
+
+    for mail in selection:
+        # Create the box on the first mail, as the selection might be streamed.
+        if box is None:
+            box = BatchWriter(create_box(dedup.conf.export, dedup.conf.export_format))
         logger.debug(f"Move {mail!r} form {mail.source_path} to {dedup.conf.export}...")
         dedup.stats["mail_moved"] += 1
         if dedup.conf.dry_run:
             logger.warning("DRY RUN: Skip action.")
         else:
-            box.add(mail)
-            dedup.sources[mail.source_path].remove(mail.mail_id)
+            box.add_mail(mail, partial(removals.add, mail))
             logger.info(f"{mail!r} copied.")
 
-    logger.debug(f"Close {dedup.conf.export}")
-    box.close()
+    if box is not None:
+        logger.debug(f"Close {dedup.conf.export}")
+        box.close()
+    removals.flush()
+
 
+def delete_selected(dedup, selection):
+    """Remove all mails selected in-place, from their original boxes.
 
-def delete_selected(dedup):
-    """Remove all mails selected in-place, from their original boxes."""
-    for mail in dedup.selection:
+    Removals are grouped by source and applied by batches.
+    """
+    removals = Removals(dedup)
+
+    for mail in selection:
         logger.debug(f"Deleting {mail!r} in-place...")
         dedup.stats["mail_deleted"] += 1
         if dedup.conf.dry_run:
             logger.warning("DRY RUN: Skip action.")
-        else:
-            dedup.sources[mail.source_path].remove(mail.mail_id)
-            logger.info(f"{mail!r} deleted.")
+            continue
+        removals.add(mail)
+
+    removals.flush()
+
+
+class Removals:
+
+    """Mails to remove from their sources, grouped by source.
+
+    Pending mails are removed every ``batch_size`` mails, one batch per source.
+    """
+
+    def __init__(self, dedup, batch_size=REMOVAL_BATCH_SIZE):
+        self.dedup = dedup
+        self.batch_size = batch_size
+        self.pending = OrderedDict()
+        self.count = 0
+
+    def add(self, mail):
+        """Queue a mail for removal from its source."""
+        self.pending.setdefault(mail.source_path, []).append(mail)
+        self.count += 1
+        if self.count >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Remove all pending mails from their sources, one batch per source."""
+        for source_path, mails in self.pending.items():
+            remove_batch(
+                self.dedup.sources[source_path], [mail.mail_id for mail in mails]
+            )
+            for mail in mails:
+                logger.info(f"{mail!r} removed from {source_path}.")
+        self.pending.clear()
+        self.count = 0
 
 
 ACTIONS = FrozenDict(
@@ -92,9 +149,22 @@ ACTIONS = FrozenDict(
 
 
 def perform_action(dedup):
-    """Performs the action on selected mail candidates."""
+    """Performs the action on selected mail candidates.
+
+    In streaming mode, the selection is produced on the fly, one duplicate set at a
+    time, and the action applied right away.
+    """
     logger.info(f"Perform {choice_style(dedup.conf.action)} action...")
 
+    # Hunt down for action implementation.
+    method = ACTIONS.get(dedup.conf.action)
+    if not method:
+        raise NotImplementedError(f"{dedup.conf.action} action not implemented yet.")
+
+    if dedup.conf.stream:
+        method(dedup, dedup.stream_selection())
+        return
+
     selection_count = len(dedup.selection)
     if selection_count == 0:
         logger.warning("No mail selected to perform action on.")
@@ -106,9 +176,4 @@ def perform_action(dedup):
     assert len(unique(dedup.selection)) == len(dedup.selection)
     assert len(dedup.selection) == dedup.stats["mail_selected"]
 
-    # Hunt down for action implementation.
-    method = ACTIONS.get(dedup.conf.action)
-    if not method:
-        raise NotImplementedError(f"{dedup.conf.action} action not implemented yet.")
-
-    method(dedup)
+    method(dedup, dedup.selection)
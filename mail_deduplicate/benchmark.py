@@ -0,0 +1,614 @@
+# Copyright Kevin Deldycke <kevin@deldycke.com> and contributors.
+# All Rights Reserved.
+#
+# This program is Free Software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+""" Benchmark suite of the deduplication phases, on generated corpora of mails.
+
+Run it with:
+
+.. code-block:: shell-session
+
+    $ python -m mail_deduplicate.benchmark --mails 10000 --output results.json
+"""
+
+import base64
+import json
+import multiprocessing
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from contextlib import redirect_stdout
+from email.utils import formatdate
+from pathlib import Path
+
+import click
+import click_log
+from boltons.dictutils import FrozenDict
+
+from . import (
+    DEFAULT_HASH_ALGORITHM,
+    HASH_ALGORITHMS,
+    Config,
+    __version__,
+    logger,
+)
+from .action import (
+    ACTIONS,
+    COPY_DISCARDED,
+    COPY_SELECTED,
+    MOVE_DISCARDED,
+    MOVE_SELECTED,
+    perform_action,
+)
+from .deduplicate import Deduplicate, peak_rss
+from .strategy import SELECT_ONE
+
+click_log.basic_config(logger)
+
+
+# Default shape of generated corpora.
+DEFAULT_MAIL_COUNT = 1000
+# Share of mails belonging to a set of duplicates.
+DEFAULT_DUPLICATE_RATIO = 0.3
+# Relative weights of each size of duplicate sets.
+DEFAULT_SET_SIZES = FrozenDict({2: 70, 3: 20, 5: 8, 10: 2})
+DEFAULT_BODY_SIZE = 2048  # bytes
+# Share of mails with a binary attachment.
+DEFAULT_ATTACHMENT_RATIO = 0.1
+DEFAULT_ATTACHMENT_SIZE = 32 * 1024  # bytes
+# Share of duplicates with a mailing-list footer appended to their body, so that
+# content differences have to be computed.
+DEFAULT_VARIANT_RATIO = 0.1
+DEFAULT_SEED = 42
+
+# Box formats in which corpora can be generated.
+CORPUS_BOX_TYPES = ("maildir", "mbox")
+
+# Dates of generated mails are spread over a year from that point in time.
+CORPUS_EPOCH = 1577836800  # 2020-01-01T00:00:00Z
+CORPUS_TIMESPAN = 365 * 24 * 3600  # seconds
+
+# Vocabulary of generated bodies.
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud "
+    "exercitation ullamco laboris nisi aliquip ex ea commodo consequat"
+).split()
+
+# Appended to some duplicates, as mailing-list servers do.
+FOOTER = (
+    "\n-- \nBenchmark mailing list\n"
+    "https://lists.example.com/mailman/listinfo/benchmark\n"
+)
+
+# Only benchmark implemented actions.
+BENCHMARK_ACTIONS = tuple(
+    sorted(action for action, method in ACTIONS.items() if method)
+)
+
+# Actions requiring a box to export mails to.
+EXPORT_ACTIONS = frozenset(
+    [COPY_SELECTED, COPY_DISCARDED, MOVE_SELECTED, MOVE_DISCARDED]
+)
+
+# Strategy applied on all duplicate sets, which always discriminates mails.
+BENCHMARK_STRATEGY = SELECT_ONE
+
+# Number of interpreters spawned to measure the start-up time of the CLI.
+STARTUP_RUNS = 5
+
+
+class Corpus:
+
+    """Deterministic generator of mail boxes filled with duplicates.
+
+    The same parameters always produce byte-for-byte the same mails, in the same
+    order, so results of different releases can be compared.
+    """
+
+    def __init__(
+        self,
+        mail_count=DEFAULT_MAIL_COUNT,
+        duplicate_ratio=DEFAULT_DUPLICATE_RATIO,
+        set_sizes=DEFAULT_SET_SIZES,
+        body_size=DEFAULT_BODY_SIZE,
+        attachment_ratio=DEFAULT_ATTACHMENT_RATIO,
+        attachment_size=DEFAULT_ATTACHMENT_SIZE,
+        variant_ratio=DEFAULT_VARIANT_RATIO,
+        seed=DEFAULT_SEED,
+    ):
+        assert mail_count > 0
+        assert 0 <= duplicate_ratio <= 1
+        assert set_sizes and min(set_sizes) >= 2
+        assert body_size > 0
+        assert 0 <= attachment_ratio <= 1
+        assert attachment_size >= 0
+        assert 0 <= variant_ratio <= 1
+
+        self.mail_count = mail_count
+        self.duplicate_ratio = duplicate_ratio
+        self.set_sizes = dict(sorted(set_sizes.items()))
+        self.body_size = body_size
+        self.attachment_ratio = attachment_ratio
+        self.attachment_size = attachment_size
+        self.variant_ratio = variant_ratio
+        self.seed = seed
+
+    @property
+    def params(self):
+        """Parameters of the corpus, to be reported along results."""
+        return {
+            "mail_count": self.mail_count,
+            "duplicate_ratio": self.duplicate_ratio,
+            "set_sizes": {str(k): v for k, v in self.set_sizes.items()},
+            "body_size": self.body_size,
+            "attachment_ratio": self.attachment_ratio,
+            "attachment_size": self.attachment_size,
+            "variant_ratio": self.variant_ratio,
+            "seed": self.seed,
+        }
+
+    def group_sizes(self, rng):
+        """Returns the number of copies of each distinct mail of the corpus."""
+        target = round(self.mail_count * self.duplicate_ratio)
+        sizes, weights = zip(*self.set_sizes.items())
+        groups = []
+        duplicated = 0
+        while target - duplicated >= 2:
+            size = min(rng.choices(sizes, weights)[0], target - duplicated)
+            groups.append(size)
+            duplicated += size
+        groups.extend([1] * (self.mail_count - duplicated))
+        return groups
+
+    def body(self, rng):
+        """Produce a plain text body of about ``body_size`` bytes."""
+        length = rng.randint(self.body_size // 2, self.body_size * 3 // 2)
+        lines = []
+        line = []
+        line_length = size = 0
+        while size < length:
+            word = rng.choice(WORDS)
+            if line_length + len(word) > 72:
+                lines.append(" ".join(line))
+                line = []
+                line_length = 0
+            line.append(word)
+            line_length += len(word) + 1
+            size += len(word) + 1
+        lines.append(" ".join(line))
+        return "\n".join(lines) + "\n"
+
+    def attachment(self, rng, index):
+        """Produce a MIME part of random binary content."""
+        data = b""
+        if self.attachment_size:
+            data = rng.getrandbits(self.attachment_size * 8).to_bytes(
+                self.attachment_size, "little"
+            )
+        encoded = base64.encodebytes(data).decode("ascii")
+        return (
+            "Content-Type: application/octet-stream\n"
+            f'Content-Disposition: attachment; filename="file-{index}.bin"\n'
+            "Content-Transfer-Encoding: base64\n"
+            f"\n{encoded}"
+        )
+
+    def mails(self):
+        """Generate the raw content of all mails of the corpus.
+
+        Returns a ``(mails, manifest)`` tuple, where ``manifest`` holds the expected
+        grouping of mails.
+        """
+        rng = random.Random(self.seed)
+        groups = self.group_sizes(rng)
+
+        mails = []
+        for index, copies in enumerate(groups):
+            date = formatdate(CORPUS_EPOCH + rng.randrange(CORPUS_TIMESPAN))
+            headers = (
+                f"Date: {date}\n"
+                f"From: sender-{rng.randrange(1000)}@example.com\n"
+                f"To: recipient-{rng.randrange(1000)}@example.net\n"
+                f"Subject: Benchmark mail #{index}\n"
+                f"Message-ID: <{index}.{self.seed}@benchmark.example.com>\n"
+                "MIME-Version: 1.0\n"
+            )
+            body = self.body(rng)
+            attachment = None
+            if rng.random() < self.attachment_ratio:
+                attachment = self.attachment(rng, index)
+
+            for copy in range(copies):
+                # Duplicates only differ by their delivery path and, sometimes, by a
+                # footer.
+                received = (
+                    f"Received: from mx{copy}.example.com by mail.example.net "
+                    f"with ESMTP id {index}-{copy}; {date}\n"
+                )
+                text = body
+                if copy and rng.random() < self.variant_ratio:
+                    text += FOOTER
+                if attachment is None:
+                    content = (
+                        'Content-Type: text/plain; charset="utf-8"\n'
+                        "Content-Transfer-Encoding: 8bit\n"
+                        f"\n{text}"
+                    )
+                else:
+                    boundary = f"=={index}.{self.seed}=="
+                    content = (
+                        f'Content-Type: multipart/mixed; boundary="{boundary}"\n'
+                        f"\n--{boundary}\n"
+                        'Content-Type: text/plain; charset="utf-8"\n'
+                        "Content-Transfer-Encoding: 8bit\n"
+                        f"\n{text}"
+                        f"--{boundary}\n"
+                        f"{attachment}"
+                        f"--{boundary}--\n"
+                    )
+                mails.append((received + headers + content).encode("utf-8"))
+
+        # Scatter duplicates across the box.
+        rng.shuffle(mails)
+
+        manifest = {
+            "mails": len(mails),
+            "unique": groups.count(1),
+            "duplicate_sets": len(groups) - groups.count(1),
+            "duplicates": sum(size for size in groups if size > 1),
+        }
+        return mails, manifest
+
+    def write(self, path, box_type):
+        """Write the corpus to a new box of ``box_type`` format at ``path``.
+
+        Returns the manifest of the corpus.
+        """
+        assert box_type in CORPUS_BOX_TYPES
+        mails, manifest = self.mails()
+        path = Path(path)
+        if box_type == "maildir":
+            for subdir in ("cur", "new", "tmp"):
+                path.joinpath(subdir).mkdir(parents=True)
+            for index, mail in enumerate(mails):
+                path.joinpath("cur", f"{index:08d}.benchmark:2,S").write_bytes(mail)
+        else:
+            with path.open("wb") as box:
+                for mail in mails:
+                    box.write(b"From MAILER-DAEMON Wed Jan  1 00:00:00 2020\n")
+                    box.write(re.sub(rb"(?m)^From ", b">From ", mail))
+                    box.write(b"\n")
+        manifest["bytes"] = sum(map(len, mails))
+        return manifest
+
+
+def bench_action(corpus, box_type, action, workdir, **options):
+    """Time all phases of the deduplication of a fresh corpus, up to ``action``.
+
+    The corpus is generated before the clock starts, and is not reused as some
+    actions alter it.
+    """
+    run_dir = Path(tempfile.mkdtemp(prefix=f"{box_type}-{action}-", dir=workdir))
+    source = run_dir.joinpath("source")
+    manifest = corpus.write(source, box_type)
+
+    if action in EXPORT_ACTIONS:
+        options["export"] = run_dir.joinpath("export")
+        options.setdefault("export_format", box_type)
+    conf = Config(strategy=BENCHMARK_STRATEGY, action=action, **options)
+
+    dedup = Deduplicate(conf)
+    with dedup.timed("load", "mail_found"):
+        dedup.add_source(source)
+    dedup.hash_all()
+    dedup.select_all()
+    # File-based boxes apply removals on close, so it is part of the action.
+    with dedup.timed("action", "mail_selected"):
+        perform_action(dedup)
+        dedup.close_all()
+    dedup.check_stats()
+
+    results = {
+        "box_type": box_type,
+        "action": action,
+        "corpus": manifest,
+        "peak_rss": peak_rss(),
+    }
+    results.update(dedup.summary())
+    return results
+
+
+def isolated_call(sender, log_level, function, args, kwargs):
+    """Entry point of the process spawned by ``run_isolated()``.
+
+    Sends back through the ``sender`` end of a pipe a ``(result, error)`` tuple.
+    """
+    logger.setLevel(log_level)
+    try:
+        # Keep progress bars out of results printed on the standard output.
+        with redirect_stdout(sys.stderr):
+            result = function(*args, **kwargs)
+    except Exception:
+        sender.send((None, traceback.format_exc()))
+    else:
+        sender.send((result, None))
+    finally:
+        sender.close()
+
+
+def run_isolated(function, *args, **kwargs):
+    """Call ``function`` in a freshly spawned interpreter and returns its result.
+
+    Peak resident memory of a process can only grow. Running each benchmark in its
+    own process keeps its peak from including the ones of earlier runs.
+    """
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(
+        target=isolated_call, args=(sender, logger.level, function, args, kwargs)
+    )
+    process.start()
+    sender.close()
+    try:
+        result, error = receiver.recv()
+    except EOFError:
+        result = None
+        error = "Benchmark process died without result."
+    finally:
+        receiver.close()
+        process.join()
+    if error:
+        raise RuntimeError(error)
+    return result
+
+
+def startup_time(runs=STARTUP_RUNS):
+    """Returns the best time to start a new interpreter and import the CLI, in
+    seconds.
+    """
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", "import mail_deduplicate.cli"],
+            cwd=str(Path(__file__).parents[1]),
+            check=True,
+        )
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run_benchmark(
+    corpus,
+    box_types=CORPUS_BOX_TYPES,
+    actions=BENCHMARK_ACTIONS,
+    workdir=None,
+    **options,
+):
+    """Benchmark each action on each box format.
+
+    Each run happens in its own process. Extra ``options`` are passed to the
+    ``Config`` of each run. Returns a JSON-serializable dict of results.
+    """
+    runs = []
+    with tempfile.TemporaryDirectory(prefix="mdedup-benchmark-", dir=workdir) as tmp:
+        for box_type in box_types:
+            for action in actions:
+                logger.info(f"Benchmark {action} on {box_type}...")
+                runs.append(
+                    run_isolated(bench_action, corpus, box_type, action, tmp, **options)
+                )
+    return {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "corpus": corpus.params,
+        "options": {k: str(v) for k, v in options.items()},
+        "startup_time": startup_time(),
+        "runs": runs,
+    }
+
+
+def parse_set_sizes(ctx, param, value):
+    """Parse a ``SIZE:WEIGHT,SIZE:WEIGHT,...`` distribution of set sizes."""
+    try:
+        sizes = {
+            int(size): int(weight)
+            for size, weight in (item.split(":") for item in value.split(","))
+        }
+    except ValueError:
+        raise click.BadParameter("expecting SIZE:WEIGHT,SIZE:WEIGHT,... format.")
+    if min(sizes) < 2:
+        raise click.BadParameter("duplicate sets are made of at least 2 mails.")
+    return sizes
+
+
+@click.command(short_help="Benchmark deduplication phases.")
+@click.option(
+    "--mails",
+    type=click.IntRange(min=1),
+    default=DEFAULT_MAIL_COUNT,
+    help=f"Number of mails in the corpus. Defaults to {DEFAULT_MAIL_COUNT}.",
+)
+@click.option(
+    "--duplicate-ratio",
+    type=click.FloatRange(0, 1),
+    default=DEFAULT_DUPLICATE_RATIO,
+    help="Share of mails belonging to a set of duplicates. Defaults to "
+    f"{DEFAULT_DUPLICATE_RATIO}.",
+)
+@click.option(
+    "--set-sizes",
+    callback=parse_set_sizes,
+    metavar="SIZE:WEIGHT,...",
+    default=",".join(f"{k}:{v}" for k, v in DEFAULT_SET_SIZES.items()),
+    help="Relative weights of each size of duplicate sets. Defaults to "
+    f"{','.join(f'{k}:{v}' for k, v in DEFAULT_SET_SIZES.items())}.",
+)
+@click.option(
+    "--body-size",
+    type=click.IntRange(min=1),
+    metavar="BYTES",
+    default=DEFAULT_BODY_SIZE,
+    help=f"Average size of mail bodies. Defaults to {DEFAULT_BODY_SIZE} bytes.",
+)
+@click.option(
+    "--attachment-ratio",
+    type=click.FloatRange(0, 1),
+    default=DEFAULT_ATTACHMENT_RATIO,
+    help="Share of mails with a binary attachment. Defaults to "
+    f"{DEFAULT_ATTACHMENT_RATIO}.",
+)
+@click.option(
+    "--attachment-size",
+    type=click.IntRange(min=0),
+    metavar="BYTES",
+    default=DEFAULT_ATTACHMENT_SIZE,
+    help=f"Size of attachments. Defaults to {DEFAULT_ATTACHMENT_SIZE} bytes.",
+)
+@click.option(
+    "--variant-ratio",
+    type=click.FloatRange(0, 1),
+    default=DEFAULT_VARIANT_RATIO,
+    help="Share of duplicates with a slightly different body. Defaults to "
+    f"{DEFAULT_VARIANT_RATIO}.",
+)
+@click.option(
+    "--seed",
+    type=int,
+    default=DEFAULT_SEED,
+    help=f"Seed of the corpus generator. Defaults to {DEFAULT_SEED}.",
+)
+@click.option(
+    "--box-type",
+    multiple=True,
+    type=click.Choice(CORPUS_BOX_TYPES),
+    default=CORPUS_BOX_TYPES,
+    help="Format of the generated boxes. Can be repeated. Defaults to all formats.",
+)
+@click.option(
+    "-a",
+    "--action",
+    multiple=True,
+    type=click.Choice(BENCHMARK_ACTIONS),
+    default=BENCHMARK_ACTIONS,
+    help="Action to benchmark. Can be repeated. Defaults to all implemented actions.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of worker processes used to hash mails. Defaults to 1.",
+)
+@click.option(
+    "--prefetch",
+    type=click.IntRange(min=0),
+    default=0,
+    help="Number of mails read ahead of their hashing. Defaults to 0.",
+)
+@click.option(
+    "--header-only",
+    is_flag=True,
+    default=False,
+    help="Only read mail headers to compute hashes.",
+)
+@click.option(
+    "--hash-algorithm",
+    default=DEFAULT_HASH_ALGORITHM,
+    type=click.Choice(sorted(HASH_ALGORITHMS), case_sensitive=False),
+    help=f"Algorithm used to compute hashes. Defaults to {DEFAULT_HASH_ALGORITHM}.",
+)
+@click.option(
+    "--workdir",
+    type=click.Path(exists=True, file_okay=False, resolve_path=True),
+    help="Directory in which corpora are generated. Defaults to the system's "
+    "temporary directory.",
+)
+@click.option(
+    "-o",
+    "--output",
+    type=click.File("w"),
+    default="-",
+    help="File to which JSON results are written. Defaults to the standard output.",
+)
+@click_log.simple_verbosity_option(
+    logger,
+    default="WARNING",
+    metavar="LEVEL",
+    type=click.Choice(
+        ["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG"], case_sensitive=False
+    ),
+    help="Either CRITICAL, ERROR, WARNING, INFO or DEBUG. Defaults to WARNING.",
+)
+def benchmark(
+    mails,
+    duplicate_ratio,
+    set_sizes,
+    body_size,
+    attachment_ratio,
+    attachment_size,
+    variant_ratio,
+    seed,
+    box_type,
+    action,
+    jobs,
+    prefetch,
+    header_only,
+    hash_algorithm,
+    workdir,
+    output,
+):
+    """Time each deduplication phase and action on generated corpora of mails.
+
+    Results are written as JSON, with wall time, CPU time, throughput and growth
+    of the peak resident memory of each phase. Each run happens in a fresh process,
+    whose whole peak resident memory is reported too.
+    """
+    corpus = Corpus(
+        mail_count=mails,
+        duplicate_ratio=duplicate_ratio,
+        set_sizes=set_sizes,
+        body_size=body_size,
+        attachment_ratio=attachment_ratio,
+        attachment_size=attachment_size,
+        variant_ratio=variant_ratio,
+        seed=seed,
+    )
+    # Keep progress bars out of results printed on the standard output.
+    with redirect_stdout(sys.stderr):
+        results = run_benchmark(
+            corpus,
+            box_types=box_type,
+            actions=action,
+            workdir=workdir,
+            jobs=jobs,
+            prefetch=prefetch,
+            header_only=header_only,
+            hash_algorithm=hash_algorithm,
+        )
+    json.dump(results, output, indent=2)
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    benchmark()  # pylint: disable=no-value-for-parameter
@@ -17,21 +17,23 @@
 
 import logging
 import re
+import sys
+from contextlib import redirect_stdout
 
 import click
 import click_log
-from click_help_colors import version_option
 
 from . import (
     CLI_NAME,
     DATE_HEADER,
     DEFAULT_CONTENT_THRESHOLD,
+    DEFAULT_HASH_ALGORITHM,
     DEFAULT_SIZE_THRESHOLD,
+    HASH_ALGORITHMS,
     HASH_HEADERS,
     TIME_SOURCES,
     Config,
     __version__,
-    env_data,
     logger,
 )
 from .colorize import (
@@ -40,8 +42,9 @@ from .colorize import (
     title_style,
     choice_style,
     colors,
+    subtitle_style,
 )
-from .deduplicate import Deduplicate
+from .deduplicate import JSON_REPORT, REPORT_FORMATS, TABLE_REPORT, Deduplicate
 from .mailbox import BOX_TYPES, BOX_STRUCTURES
 from .action import (
     ACTIONS,
@@ -62,6 +65,25 @@ from .strategy import (
 click_log.basic_config(logger)
 
 
+def print_version(ctx, param, value):
+    """Print the version and the profile of the environment, then exit.
+
+    The profile is slow to collect, so it is only produced on demand.
+    """
+    if not value or ctx.resilient_parsing:
+        return
+    from boltons.ecoutils import get_profile
+
+    click.echo(
+        click.style(CLI_NAME, fg=colors["cli"]["fg"])
+        + click.style(" ", fg="bright_black")
+        + click.style(__version__, fg="green")
+        + click.style(f"\n{get_profile(scrub=True)}", fg="bright_black"),
+        color=ctx.color,
+    )
+    ctx.exit()
+
+
 def validate_regexp(ctx, param, value):
     """ Validate and compile regular expression. """
     if value:
@@ -108,6 +130,40 @@ def validate_regexp(ctx, param, value):
     help="Compute and display the internal hashes used to identify duplicates. Do not "
     "performs any selection or action.",
 )
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    metavar="INTEGER",
+    default=1,
+    help="Number of worker processes used to parse and hash mails in parallel. "
+    "Defaults to 1, i.e. all mails are hashed in the current process.",
+)
+@click.option(
+    "--prefetch",
+    type=click.IntRange(min=0),
+    metavar="INTEGER",
+    default=0,
+    help="Number of mails read concurrently ahead of their parsing and hashing, to "
+    "hide latency of network storage. Only applies to a single job. Defaults to 0, "
+    "i.e. mails are read one after the other.",
+)
+@click.option(
+    "--header-only",
+    is_flag=True,
+    default=False,
+    help="Only read and parse mail headers to compute hashes. Bodies are read later, "
+    "and only for mails sharing their hash with others. Saves I/O and memory on "
+    "boxes with lots of big attachments.",
+)
+@click.option(
+    "--index",
+    metavar="INDEX_PATH",
+    type=click.Path(dir_okay=False, resolve_path=True),
+    help="Location of a persistent index of mail hashes. Hashes of mails which did "
+    "not changed since the previous run are reused from the index instead of being "
+    "computed again. The index is created if it doesn't exist.",
+)
 @click.option(
     "-h",
     "--hash-header",
@@ -121,6 +177,14 @@ def validate_regexp(ctx, param, value):
         " ".join([f"-h {choice_style(h)}" for h in HASH_HEADERS])
     ),
 )
+@click.option(
+    "--hash-algorithm",
+    default=DEFAULT_HASH_ALGORITHM,
+    type=click.Choice(sorted(HASH_ALGORITHMS), case_sensitive=False),
+    help="Algorithm used to compute each mail's hash from its headers. Faster "
+    "algorithms with shorter digests reduce CPU time and memory usage on big mail "
+    f"boxes. Defaults to {DEFAULT_HASH_ALGORITHM}.",
+)
 @click.option(
     "-S",
     "--size-threshold",
@@ -211,6 +275,40 @@ def validate_regexp(ctx, param, value):
     f"Defaults to mbox. Only affects {COPY_SELECTED}, {COPY_DISCARDED}, "
     f"{MOVE_SELECTED} and {MOVE_DISCARDED} actions.",
 )
+@click.option(
+    "--stream",
+    is_flag=True,
+    default=False,
+    help="Perform the action on the mails selected in each subset of duplicates as "
+    "soon as the subset is processed, instead of gathering the whole selection "
+    "first. Keeps memory usage bounded on big mail boxes, but interleaves phase #2 "
+    "and phase #3.",
+)
+@click.option(
+    "--report-format",
+    default=TABLE_REPORT,
+    type=click.Choice(sorted(REPORT_FORMATS), case_sensitive=False),
+    help=f"Format of the final report. {JSON_REPORT} is meant for monitoring tools: "
+    "the report is then the only content printed on the standard output. Defaults "
+    f"to {TABLE_REPORT}.",
+)
+@click.option(
+    "--events",
+    metavar="EVENTS_PATH",
+    type=click.Path(dir_okay=False, resolve_path=True),
+    help="Location of a file to which the outcome of the selection in each duplicate "
+    "set is streamed, as one JSON record per line: hash, size, decision, selected "
+    "mails and timing.",
+)
+@click.option(
+    "--profile",
+    metavar="PROFILE_DIR",
+    type=click.Path(file_okay=False, resolve_path=True),
+    help="Profile each phase with cProfile, and save its statistics to a "
+    "<phase>.prof file in PROFILE_DIR, to be analyzed with pstats or any compatible "
+    "viewer. The hottest functions of each phase are listed in the report. Slows "
+    "down the whole process. Worker processes are not profiled.",
+)
 @click.argument(
     "mail_sources",
     nargs=-1,
@@ -226,13 +324,13 @@ def validate_regexp(ctx, param, value):
     ),
     help="Either CRITICAL, ERROR, WARNING, INFO or DEBUG. Defaults to INFO.",
 )
-@version_option(
-    version=__version__,
-    prog_name=CLI_NAME,
-    version_color="green",
-    prog_name_color=colors["cli"]["fg"],
-    message=f"%(prog)s %(version)s\n{env_data}",
-    message_color="bright_black",
+@click.option(
+    "--version",
+    is_flag=True,
+    expose_value=False,
+    is_eager=True,
+    callback=print_version,
+    help="Show the version and exit.",
 )
 @click.pass_context
 def mdedup(
@@ -241,7 +339,12 @@ def mdedup(
     input_format,
     force_unlock,
     hash_only,
+    jobs,
+    prefetch,
+    header_only,
+    index,
     hash_header,
+    hash_algorithm,
     size_threshold,
     content_threshold,
     show_diff,
@@ -251,6 +354,10 @@ def mdedup(
     action,
     export,
     export_format,
+    stream,
+    report_format,
+    events,
+    profile,
     mail_sources,
 ):
     """Deduplicate mails from a set of mail boxes.
@@ -348,7 +455,12 @@ def mdedup(
         input_format=input_format,
         force_unlock=force_unlock,
         hash_only=hash_only,
+        jobs=jobs,
+        prefetch=prefetch,
+        header_only=header_only,
+        index=index,
         hash_headers=hash_header,
+        hash_algorithm=hash_algorithm,
         size_threshold=size_threshold,
         content_threshold=content_threshold,
         show_diff=show_diff,
@@ -358,37 +470,68 @@ def mdedup(
         action=action,
         export=export,
         export_format=export_format,
+        stream=stream,
+        events=events,
+        profile=profile,
     )
 
+    # Keep the standard output for the JSON report alone.
+    stdout = sys.stdout
+    if report_format == JSON_REPORT:
+        ctx.with_resource(redirect_stdout(sys.stderr))
+
     dedup = Deduplicate(conf)
+    # Keep all events written so far, whatever the way we exit.
+    ctx.call_on_close(dedup.close_events)
 
     click.echo(title_style("\n● Phase #0 - Load mails"))
-    with click.progressbar(
-        mail_sources,
-        length=len(mail_sources),
-        label="Mail sources",
-        show_pos=True,
-    ) as progress:
-        for source in progress:
-            dedup.add_source(source)
+    with dedup.timed("load", "mail_found"):
+        with click.progressbar(
+            mail_sources,
+            length=len(mail_sources),
+            label="Mail sources",
+            show_pos=True,
+        ) as progress:
+            for source in progress:
+                dedup.add_source(source)
 
     click.echo(title_style("\n● Phase #1 - Compute hashes and group duplicates"))
     dedup.hash_all()
     if hash_only:
         for all_mails in dedup.mails.values():
             for mail in all_mails:
-                click.echo(mail.pretty_headers)
+                click.echo(mail.message.pretty_canonical_headers)
                 click.echo(f"Hash: {mail.hash_key}")
         ctx.exit()
 
-    click.echo(title_style("\n● Phase #2 - Select mails in each group"))
-    dedup.select_all()
+    if stream:
+        click.echo(
+            title_style(
+                "\n● Phase #2 & #3 - Select mails in each group and perform action on "
+                "them"
+            )
+        )
+        phase_id, stat_id = "stream", "mail_retained"
+    else:
+        click.echo(title_style("\n● Phase #2 - Select mails in each group"))
+        dedup.select_all()
 
-    click.echo(title_style("\n● Phase #3 - Perform action on selected mails"))
-    perform_action(dedup)
-    dedup.close_all()
+        click.echo(title_style("\n● Phase #3 - Perform action on selected mails"))
+        phase_id, stat_id = "action", "mail_selected"
+    # Pending changes to file-based boxes are only written on close.
+    with dedup.timed(phase_id, stat_id):
+        perform_action(dedup)
+        dedup.close_all()
 
     click.echo(title_style("\n● Phase #4 - Report and statistics"))
     # Print deduplication statistics, then performs a self-check on them.
-    click.echo(dedup.report())
+    if report_format == JSON_REPORT:
+        click.echo(dedup.json_report(), file=stdout)
+    else:
+        click.echo(dedup.report())
+        click.echo(subtitle_style("◼ Performances"))
+        click.echo(dedup.performance_report())
+        if profile:
+            click.echo(subtitle_style("◼ Profiling"))
+            click.echo(dedup.profile_report())
     dedup.check_stats()
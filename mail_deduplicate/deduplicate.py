@@ -15,22 +15,39 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
+import json
+import sys
 import textwrap
+import time
 from collections import Counter, OrderedDict
-from difflib import unified_diff
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from itertools import combinations
 from operator import attrgetter
 from pathlib import Path
 
 import click
 from boltons.cacheutils import cachedproperty
-from tabulate import tabulate
 
 from . import ContentDiffAboveThreshold, SizeDiffAboveThreshold, TooFewHeaders, logger
 from .colorize import choice_style, subtitle_style
-from .mailbox import open_box
+from .mail import MailRecord
+from .mailbox import (
+    BOX_STRUCTURES,
+    BOX_TYPES,
+    MappedBox,
+    box_type_id,
+    open_box,
+    read_headers,
+)
 from .strategy import apply_strategy
 
+# Not available on Windows.
+try:
+    import resource
+except ImportError:
+    resource = None
+
 # Reference all tracked statistics and their definition.
 STATS_DEF = OrderedDict(
     [
@@ -106,6 +123,204 @@ STATS_DEF = OrderedDict(
 )
 
 
+# Reference all tracked performance metrics and their definition.
+METRICS_DEF = OrderedDict(
+    [
+        (
+            "hash_bytes",
+            "Bytes of mail content read and parsed to compute hashes.",
+        ),
+        (
+            "diff_comparisons",
+            "Number of pairs of distinct mail bodies compared line by line.",
+        ),
+        ("biggest_set", "Number of mails in the biggest duplicate set."),
+    ]
+)
+
+
+# Timed phases of the deduplication process.
+PHASES_DEF = OrderedDict(
+    [
+        ("load", "Phase #0 - Load mails"),
+        ("hash", "Phase #1 - Compute hashes"),
+        ("select", "Phase #2 - Select mails"),
+        ("action", "Phase #3 - Perform action"),
+        ("stream", "Phase #2 & #3 - Select mails and perform action"),
+    ]
+)
+
+
+# Number of hottest functions of each phase listed in the report when profiling.
+PROFILE_TOP = 5
+
+
+# Formats in which the final report can be produced.
+TABLE_REPORT = "table"
+JSON_REPORT = "json"
+REPORT_FORMATS = frozenset([TABLE_REPORT, JSON_REPORT])
+
+
+def peak_rss():
+    """Returns the peak resident memory of the current process, in bytes.
+
+    Returns ``None`` on platforms lacking the ``resource`` module.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, in kilobytes everywhere else.
+    if sys.platform != "darwin":
+        peak *= 1024
+    return peak
+
+
+# Maximum number of mails from folder-based boxes sent to a worker process at once.
+HASH_CHUNK_SIZE = 256
+
+
+def read_mail(box, mail_id, conf):
+    """Read the raw content of a mail, as required to hash it.
+
+    Returns the headers only if ``conf.header_only`` is set, else the whole mail.
+    """
+    if conf.header_only:
+        return read_headers(box, mail_id)
+    return box.get_bytes(mail_id)
+
+
+def load_mail(box, mail_id, conf, raw=None):
+    """Parse a mail from its box and attach to it its origin and the global config.
+
+    If ``conf.header_only`` is set, only the headers of the mail are read and parsed.
+    The returned mail has an empty body then.
+
+    ``raw`` is the content of the mail as returned by ``read_mail()``, if it has
+    already been read.
+    """
+    if raw is not None:
+        mail = box._factory(raw)
+    elif conf.header_only:
+        mail = box._factory(read_headers(box, mail_id))
+    else:
+        mail = box[mail_id]
+    mail.add_box_metadata(box, mail_id)
+    mail.conf = conf
+    return mail
+
+
+def hash_mails(box_type, box_path, mail_ids, conf, toc=None):
+    """Compute the hashes of a chunk of mails from a box.
+
+    Meant to be called in a worker process, so the box is re-opened from its path,
+    without locking it as the main process already holds the lock.
+
+    ``toc`` is the table of contents of the box, as read by the main process, which
+    covers at least all ``mail_ids``. It is seeded into maildirs so workers never
+    list and scan the whole box again to locate the chunk's mails.
+
+    Returns a list of ``(uid, digest, size, timestamp, rejection)`` tuples,
+    in the same order as ``mail_ids``, and the number of bytes read. ``rejection``
+    is the reason why the mail could not be hashed, in which case all other
+    metadata are ``None``.
+    """
+    box = BOX_TYPES[box_type](box_path)
+    if toc is not None:
+        box._toc = toc
+    results = []
+    hash_bytes = 0
+    for mail_id in mail_ids:
+        raw = read_mail(box, mail_id, conf)
+        hash_bytes += len(raw)
+        mail = load_mail(box, mail_id, conf, raw)
+        try:
+            digest = mail.digest
+        except TooFewHeaders as expt:
+            results.append((mail.uid, None, None, None, expt.args[0]))
+            continue
+        # Let the main process deal with bodies we can't decode: it knows how to
+        # skip the whole duplicate set.
+        size = None
+        if not conf.header_only:
+            try:
+                size = mail.size
+            except UnicodeDecodeError:
+                pass
+        results.append((mail.uid, digest, size, mail.timestamp, None))
+    box.close()
+    return results, hash_bytes
+
+
+def diff_cost(lines_a, lines_b, max_cost):
+    """Compute the cost of the line-based edit script between two lists of lines.
+
+    Cost is the sum of the length of all deleted and inserted lines. Uses Myers'
+    O(ND) algorithm to find the shortest edit script, bounded to ``max_cost`` edits.
+    As lines are never empty, the cost is at least the number of edits. So we can
+    stop the search early as soon as the bound is exceeded.
+
+    Returns ``max_cost + 1`` if the cost is greater than ``max_cost``.
+    """
+    exceeded = max_cost + 1
+
+    # Trim lines shared at the beginning and at the end.
+    start = 0
+    end_a, end_b = len(lines_a), len(lines_b)
+    while start < end_a and start < end_b and lines_a[start] == lines_b[start]:
+        start += 1
+    while end_a > start and end_b > start and lines_a[end_a - 1] == lines_b[end_b - 1]:
+        end_a -= 1
+        end_b -= 1
+    lines_a = lines_a[start:end_a]
+    lines_b = lines_b[start:end_b]
+    len_a, len_b = len(lines_a), len(lines_b)
+
+    # The difference of total length is a cheap lower bound of the cost.
+    if abs(sum(map(len, lines_a)) - sum(map(len, lines_b))) > max_cost:
+        return exceeded
+
+    # Furthest reaching x position on each k diagonal, and their history to
+    # backtrack the edit script.
+    furthest = {1: 0}
+    trace = []
+    found = False
+    for edits in range(min(len_a + len_b, max_cost) + 1):
+        trace.append(furthest.copy())
+        for k in range(-edits, edits + 1, 2):
+            if k == -edits or (k != edits and furthest[k - 1] < furthest[k + 1]):
+                x = furthest[k + 1]
+            else:
+                x = furthest[k - 1] + 1
+            y = x - k
+            while x < len_a and y < len_b and lines_a[x] == lines_b[y]:
+                x += 1
+                y += 1
+            furthest[k] = x
+            if x >= len_a and y >= len_b:
+                found = True
+                break
+        if found:
+            break
+    if not found:
+        return exceeded
+
+    # Backtrack the edit script to sum-up the length of edited lines.
+    cost = 0
+    x, y = len_a, len_b
+    for edits in range(len(trace) - 1, 0, -1):
+        previous = trace[edits]
+        k = x - y
+        if k == -edits or (k != edits and previous[k - 1] < previous[k + 1]):
+            x = previous[k + 1]
+            y = x - k - 1
+            cost += len(lines_b[y])
+        else:
+            x = previous[k - 1]
+            y = x - k + 1
+            cost += len(lines_a[x])
+    return cost if cost <= max_cost else exceeded
+
+
 class DuplicateSet:
 
     """A duplicate set of mails sharing the same hash.
@@ -134,6 +349,10 @@ class DuplicateSet:
         # Set metrics.
         self.stats = Counter()
         self.stats["mail_duplicates"] += self.size
+        self.metrics = Counter()
+
+        # Outcome of the selection, named after its ``set_*`` statistics.
+        self.decision = None
 
         logger.debug(f"{self!r} created.")
 
@@ -166,9 +385,9 @@ class DuplicateSet:
         """Ensures all mail differs in the limits imposed by size and content
         thresholds.
 
-        Compare all mails of the duplicate set with each other, both in size
-        and content. Raise an error if we're not within the limits imposed by
-        the threshold settings.
+        Compare all mails of the duplicate set with each other, first in size, then
+        in content. Raise an error if we're not within the limits imposed by the
+        threshold settings.
         """
         logger.info("Check mail differences are below the thresholds.")
         if self.conf.size_threshold < 0:
@@ -178,53 +397,59 @@ class DuplicateSet:
         if self.conf.size_threshold < 0 and self.conf.content_threshold < 0:
             return
 
-        # Compute differences of mail against one another.
-        for mail_a, mail_b in combinations(self.pool, 2):
-
-            # Compare mails on size.
-            if self.conf.size_threshold > -1:
-                size_difference = abs(mail_a.size - mail_b.size)
-                logger.debug(
-                    f"{mail_a!r} and {mail_b!r} differs by {size_difference} bytes "
-                    "in size."
-                )
-                if size_difference > self.conf.size_threshold:
-                    raise SizeDiffAboveThreshold
-
-            # Compare mails on content.
-            if self.conf.content_threshold > -1:
+        # Mails are within the size threshold if the extremes are. Sizes are checked
+        # first as they might be known without having to decode the bodies.
+        if self.conf.size_threshold > -1:
+            size_difference = self.biggest_size - self.smallest_size
+            logger.debug(
+                f"Mails differs by at most {size_difference} bytes in size "
+                f"({self.smallest_size} to {self.biggest_size} bytes)."
+            )
+            if size_difference > self.conf.size_threshold:
+                raise SizeDiffAboveThreshold
+
+        # Compute content differences of mail against one another. Mails sharing the
+        # same body digest are strictly identical, so we only need to compare one
+        # representative of each distinct body.
+        if self.conf.content_threshold > -1:
+            bodies = {}
+            for mail in self.pool:
+                bodies.setdefault(mail.body_digest, mail)
+            logger.debug(f"{len(bodies)} distinct bodies found in {self!r}.")
+            for mail_a, mail_b in combinations(bodies.values(), 2):
                 content_difference = self.diff(mail_a, mail_b)
-                logger.debug(
-                    f"{mail_a!r} and {mail_b!r} differs by {content_difference} bytes "
-                    "in content."
-                )
                 if content_difference > self.conf.content_threshold:
+                    logger.debug(
+                        f"{mail_a!r} and {mail_b!r} differs by more than "
+                        f"{self.conf.content_threshold} bytes in content."
+                    )
                     if self.conf.show_diff:
                         logger.info(self.pretty_diff(mail_a, mail_b))
                     raise ContentDiffAboveThreshold
+                logger.debug(
+                    f"{mail_a!r} and {mail_b!r} differs by {content_difference} bytes "
+                    "in content."
+                )
 
     def diff(self, mail_a, mail_b):
-        # TODO: rewrite the diff algorithm to not rely on naive unified diff
-        # result parsing.
-        """Return difference in bytes between two mails' normalized body."""
-        return len(
-            "".join(
-                unified_diff(
-                    mail_a.body_lines,
-                    mail_b.body_lines,
-                    # Ignore difference in filename lengths and timestamps.
-                    fromfile="a",
-                    tofile="b",
-                    fromfiledate="",
-                    tofiledate="",
-                    n=0,
-                    lineterm="\n",
-                )
-            )
+        """Return difference in bytes between two mails' normalized body.
+
+        Difference is the total length of lines to remove from and add to the body of
+        ``mail_a`` to get the body of ``mail_b``. Computation stops as soon as the
+        difference exceeds the content threshold, in which case any value above the
+        threshold is returned.
+        """
+        if mail_a.body_digest == mail_b.body_digest:
+            return 0
+        self.metrics["diff_comparisons"] += 1
+        return diff_cost(
+            mail_a.body_lines, mail_b.body_lines, self.conf.content_threshold
         )
 
     def pretty_diff(self, mail_a, mail_b):
         """Returns a verbose unified diff between two mails' normalized body."""
+        from difflib import unified_diff
+
         return "".join(
             unified_diff(
                 mail_a.body_lines,
@@ -250,22 +475,26 @@ class DuplicateSet:
         except UnicodeDecodeError as expt:
             logger.warning("Skip set: unparseable mails due to bad encoding.")
             logger.debug(f"{expt}")
+            self.decision = "skipped_encoding"
             self.stats["mail_skipped"] += self.size
             self.stats["set_skipped_encoding"] += 1
             return
         except SizeDiffAboveThreshold:
             logger.warning("Skip set: mails are too dissimilar in size.")
+            self.decision = "skipped_size"
             self.stats["mail_skipped"] += self.size
             self.stats["set_skipped_size"] += 1
             return
         except ContentDiffAboveThreshold:
             logger.warning("Skip set: mails are too dissimilar in content.")
+            self.decision = "skipped_content"
             self.stats["mail_skipped"] += self.size
             self.stats["set_skipped_content"] += 1
             return
 
         if not self.conf.strategy:
             logger.warning("Skip set: no strategy to apply.")
+            self.decision = "skipped_strategy"
             self.stats["mail_skipped"] += self.size
             self.stats["set_skipped_strategy"] += 1
             return
@@ -280,11 +509,13 @@ class DuplicateSet:
                 f"Skip set: all {candidate_count} mails within were selected. "
                 "The strategy criterion was not able to discard some."
             )
+            self.decision = "skipped_strategy"
             self.stats["mail_skipped"] += self.size
             self.stats["set_skipped_strategy"] += 1
             return
 
         logger.info(f"{candidate_count} mail candidates selected for action.")
+        self.decision = "deduplicated"
         self.stats["mail_selected"] += candidate_count
         self.stats["mail_discarded"] += self.size - candidate_count
         self.stats["set_deduplicated"] += 1
@@ -311,12 +542,106 @@ class Deduplicate:
         # Mails selected after application of selection strategy.
         self.selection = set()
 
+        # Persistent index of hashes from previous runs.
+        self.index = None
+        if conf.index:
+            # Spare loading of SQLite if not needed.
+            from .index import HashIndex
+
+            self.index = HashIndex(conf.index, conf)
+
         # Global config.
         self.conf = conf
 
         # Deduplication statistics.
         self.stats = Counter(dict.fromkeys(STATS_DEF, 0))
 
+        # Performance metrics, and timings of each phase.
+        self.metrics = Counter(dict.fromkeys(METRICS_DEF, 0))
+        self.timings = OrderedDict()
+
+        # Hottest functions of each phase, if profiled.
+        self.hotspots = OrderedDict()
+
+        # Stream of selection events, one JSON record per duplicate set.
+        self.events = None
+        if conf.events:
+            self.events = open(conf.events, "w", encoding="utf-8")
+
+    @contextmanager
+    def timed(self, phase_id, stat_id):
+        """Measure the resources spent in the enclosed phase.
+
+        Throughput is computed from the ``stat_id`` counter of processed mails. CPU
+        time only accounts for the current process, not for worker processes. Same
+        for the profiling of the phase, if ``conf.profile`` is set. Phases failing
+        halfway are measured too.
+
+        Peak resident memory of a process can only grow, so the memory of a phase is
+        measured as the growth of that peak: how much memory the phase required on
+        top of the peak reached by earlier phases. It is zero for phases staying
+        below that peak.
+        """
+        assert phase_id in PHASES_DEF
+        profiler = None
+        if self.conf.profile:
+            import cProfile
+
+            profiler = cProfile.Profile()
+            profiler.enable()
+        rss_start = peak_rss()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - wall_start
+            cpu_time = time.process_time() - cpu_start
+            if profiler:
+                profiler.disable()
+                self.save_profile(phase_id, profiler)
+            mails = self.stats[stat_id]
+            rss_growth = None
+            if rss_start is not None:
+                rss_growth = peak_rss() - rss_start
+            self.timings[phase_id] = {
+                "mails": mails,
+                "wall_time": wall_time,
+                "cpu_time": cpu_time,
+                "mails_per_second": mails / wall_time if wall_time else None,
+                "peak_rss_growth": rss_growth,
+            }
+
+    def save_profile(self, phase_id, profiler):
+        """Dump the profile of a phase to its own file, and keep its hottest
+        functions.
+        """
+        import pstats
+
+        folder = Path(self.conf.profile)
+        folder.mkdir(parents=True, exist_ok=True)
+        profile_path = folder.joinpath(f"{phase_id}.prof")
+        profiler.dump_stats(str(profile_path))
+        logger.info(f"Profile saved to {choice_style(str(profile_path))}")
+
+        # Rank functions by the time spent in their own code.
+        stats = pstats.Stats(profiler).stats
+        hottest = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)
+        hotspots = self.hotspots[phase_id] = []
+        for (filename, lineno, funcname), row in hottest[:PROFILE_TOP]:
+            _, calls, own_time, cumulative_time, _ = row
+            # Built-in functions have no location.
+            if filename != "~":
+                funcname = f"{funcname} ({Path(filename).name}:{lineno})"
+            hotspots.append(
+                {
+                    "function": funcname,
+                    "calls": calls,
+                    "own_time": own_time,
+                    "cumulative_time": cumulative_time,
+                }
+            )
+
     def add_source(self, source_path):
         """Registers a source of mails, validates and opens it. """
         # Make the path absolute, resolving any symlinks. Do not allow duplicates in
@@ -348,38 +673,219 @@ class Deduplicate:
             "compute hashes."
         )
 
-        with click.progressbar(
-            length=self.stats["mail_found"],
-            label="Hashed mails",
-            show_pos=True,
-        ) as progress:
+        with self.timed("hash", "mail_found"):
+            with click.progressbar(
+                length=self.stats["mail_found"],
+                label="Hashed mails",
+                show_pos=True,
+            ) as progress:
+                if self.conf.jobs > 1:
+                    self.hash_parallel(progress)
+                elif self.conf.prefetch:
+                    self.hash_prefetch(progress)
+                else:
+                    self.hash_serial(progress)
+
+            if self.index:
+                self.index.close()
 
-            for box in self.sources.values():
-                for mail_id, mail in box.iteritems():
+        self.stats["mail_hashes"] += len(self.mails)
 
-                    mail.add_box_metadata(box, mail_id)
+    def add_result(self, box, mail_id, digest, rejection=None, **metadata):
+        """Register the outcome of the hashing of a mail.
 
-                    mail.conf = self.conf
+        Rejected mails are only accounted for. Others are grouped by the binary digest
+        of their canonical hash, and referenced by a compact ``MailRecord`` carrying the
+        provided metadata.
+        """
+        if rejection:
+            logger.warning(f"Rejecting {box._path}:{mail_id}: {rejection}")
+            self.stats["mail_rejected"] += 1
+        else:
+            record = MailRecord(box, mail_id, digest, self.conf, **metadata)
+            self.mails.setdefault(digest, []).append(record)
+            self.stats["mail_retained"] += 1
 
-                    try:
-                        mail_hash = mail.hash_key
-                    except TooFewHeaders as expt:
-                        logger.warning(f"Rejecting {mail!r}: {expt.args[0]}")
-                        self.stats["mail_rejected"] += 1
-                    else:
-                        # Use a set to deduplicate entries pointing to the same file.
-                        self.mails.setdefault(mail_hash, set()).add(mail)
-                        self.stats["mail_retained"] += 1
+    def hash_from_index(self, box, mail_id):
+        """Reuse the hash and metadata of a mail from the persistent index.
+
+        Returns ``True`` if the mail was found in the index and up to date.
+        """
+        if not self.index:
+            return False
+        indexed = self.index.get(box, mail_id)
+        if indexed is None:
+            return False
+        self.add_indexed(box, mail_id, indexed)
+        return True
+
+    def add_indexed(self, box, mail_id, indexed):
+        """Register the hash and metadata of a mail as found in the index."""
+        digest, size, timestamp, rejection = indexed
+        self.add_result(box, mail_id, digest, rejection, size=size, timestamp=timestamp)
+
+    def index_result(self, box, mail_id, digest, size, timestamp, rejection):
+        """Persist the hash and metadata of a mail in the index, if any."""
+        if self.index:
+            self.index.put(box, mail_id, digest, size, timestamp, rejection)
+
+    def hash_serial(self, progress):
+        """Parse and hash mails one after the other, in the current process."""
+        for box in self.sources.values():
+            for mail_id in box.iterkeys():
+                if not self.hash_from_index(box, mail_id):
+                    self.hash_mail(box, mail_id)
+                progress.update(1)
+
+    def hash_mail(self, box, mail_id, raw=None):
+        """Parse and hash a single mail."""
+        if raw is None:
+            raw = read_mail(box, mail_id, self.conf)
+        self.metrics["hash_bytes"] += len(raw)
+        mail = load_mail(box, mail_id, self.conf, raw)
+        try:
+            digest = mail.digest
+        except TooFewHeaders as expt:
+            self.index_result(box, mail_id, None, None, None, expt.args[0])
+            self.add_result(box, mail_id, None, expt.args[0])
+            return
+
+        # Parsed mail is not kept around: records only carries its metadata. Size is
+        # not computed yet as it requires the body to be decoded.
+        self.index_result(box, mail_id, digest, None, mail.timestamp, None)
+        self.add_result(box, mail_id, digest, timestamp=mail.timestamp)
+
+    def hash_prefetch(self, progress):
+        """Parse and hash mails one after the other, while reading them ahead.
 
+        Reads are performed by a pool of threads, orchestrated by an asyncio loop.
+        Mails are still parsed and hashed in the current process, and in the same
+        order as in ``hash_serial()``. So results are strictly the same.
+        """
+        import asyncio
+
+        logger.info(f"Prefetch up to {self.conf.prefetch} mails concurrently.")
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.prefetch_mails(loop, progress))
+        finally:
+            loop.close()
+
+    async def prefetch_mails(self, loop, progress):
+        """Hash mails as they are made available by a concurrent reader."""
+        import asyncio
+
+        # Bound the number of mails read ahead of the hashing.
+        queue = asyncio.Queue(maxsize=self.conf.prefetch)
+
+        with ThreadPoolExecutor(max_workers=self.conf.prefetch) as executor:
+
+            async def produce():
+                for box in self.sources.values():
+                    # Boxes sharing a single file handle can't be read concurrently.
+                    concurrent = isinstance(box, MappedBox) or (
+                        box_type_id(box) in BOX_STRUCTURES["folder"]
+                    )
+                    for mail_id in box.iterkeys():
+                        indexed = self.index.get(box, mail_id) if self.index else None
+                        raw = None
+                        if indexed is None and concurrent:
+                            raw = loop.run_in_executor(
+                                executor, read_mail, box, mail_id, self.conf
+                            )
+                        await queue.put((box, mail_id, indexed, raw))
+                await queue.put(None)
+
+            producer = asyncio.ensure_future(produce())
+            try:
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        break
+                    box, mail_id, indexed, raw = item
+                    if indexed is not None:
+                        self.add_indexed(box, mail_id, indexed)
+                    else:
+                        if raw is not None:
+                            raw = await raw
+                        self.hash_mail(box, mail_id, raw)
                     progress.update(1)
+                    # Let the producer top up the queue.
+                    await asyncio.sleep(0)
+                await producer
+            finally:
+                producer.cancel()
 
-        self.stats["mail_hashes"] += len(self.mails)
+    def hash_chunks(self):
+        """Split all mails from all sources into chunks of work.
 
-    def select_all(self):
-        """Gather the final selection of mails from each duplicate set.
+        Mails already indexed are registered right away and are not part of any
+        chunk.
 
-        We apply the selection strategy one duplicate set at a time to keep memory
-        footprint low and make the log easier to read.
+        Mails from file-based boxes are kept in one chunk per box, as each worker has
+        to scan the whole file to index its content. Mails from folder-based boxes
+        are dispatched in chunks of ``HASH_CHUNK_SIZE``, along with the entries of
+        the maildir's table of contents locating them.
+
+        Yields ``(box, box_type, mail_ids, toc)`` tuples.
+        """
+        for box in self.sources.values():
+            box_type = box_type_id(box)
+            mail_ids = [
+                mail_id
+                for mail_id in box.iterkeys()
+                if not self.hash_from_index(box, mail_id)
+            ]
+            chunk_size = len(mail_ids)
+            if box_type in BOX_STRUCTURES["folder"]:
+                chunk_size = HASH_CHUNK_SIZE
+            for start in range(0, len(mail_ids), max(chunk_size, 1)):
+                chunk = mail_ids[start : start + chunk_size]
+                toc = None
+                if box_type == "maildir":
+                    toc = {mail_id: box._toc[mail_id] for mail_id in chunk}
+                yield box, box_type, chunk, toc
+
+    def hash_parallel(self, progress):
+        """Dispatch parsing and hashing of mails to a pool of worker processes.
+
+        Workers only send back compact metadata, which are merged in the order the
+        chunks were produced. Grouping of mails is then strictly the same as in
+        serial mode.
+        """
+        # Importing multiprocessing machinery is costly and only required here.
+        from concurrent.futures import ProcessPoolExecutor
+
+        logger.info(f"Hash mails with {self.conf.jobs} parallel jobs.")
+        with ProcessPoolExecutor(max_workers=self.conf.jobs) as executor:
+            futures = [
+                (
+                    box,
+                    executor.submit(
+                        hash_mails, box_type, box._path, ids, self.conf, toc
+                    ),
+                )
+                for box, box_type, ids, toc in self.hash_chunks()
+            ]
+            # Account for mails registered from the index while chunking.
+            progress.update(self.stats["mail_retained"] + self.stats["mail_rejected"])
+            for box, future in futures:
+                results, hash_bytes = future.result()
+                self.metrics["hash_bytes"] += hash_bytes
+                for uid, digest, size, timestamp, rejection in results:
+                    _, mail_id = uid
+                    self.index_result(box, mail_id, digest, size, timestamp, rejection)
+                    self.add_result(
+                        box, mail_id, digest, rejection, size=size, timestamp=timestamp
+                    )
+                    progress.update(1)
+
+    def iter_selection(self):
+        """Apply the selection strategy on each duplicate set, one after the other.
+
+        Yields the set of mails selected in each duplicate set. Mails are released
+        from their group as we go, so they can be reclaimed as soon as the consumer
+        is done with them.
         """
         if self.conf.strategy:
             logger.info(
@@ -391,10 +897,13 @@ class Deduplicate:
 
         self.stats["set_total"] = len(self.mails)
 
-        for hash_key, mail_set in self.mails.items():
+        for digest in list(self.mails):
+            mail_set = self.mails.pop(digest)
+            hash_key = digest.hex()
 
             # Alter log level depending on set length.
             mail_count = len(mail_set)
+            self.metrics["biggest_set"] = max(self.metrics["biggest_set"], mail_count)
             log_level = logger.debug if mail_count == 1 else logger.info
             log_level(subtitle_style(f"◼ {mail_count} mails sharing hash {hash_key}"))
 
@@ -411,21 +920,74 @@ class Deduplicate:
             # within the set.
             else:
                 duplicates = DuplicateSet(hash_key, mail_set, self.conf)
+                start = time.perf_counter()
                 candidates = duplicates.select_candidates()
-                # Merge duplicate set's stats to global stats.
+                self.log_event(duplicates, candidates, time.perf_counter() - start)
+                # Merge duplicate set's stats and metrics to global ones.
                 self.stats += duplicates.stats
+                self.metrics += duplicates.metrics
 
             if candidates:
+                yield candidates
+
+            # Full messages are not needed anymore once the set has been processed.
+            for mail in mail_set:
+                mail.release()
+
+    def log_event(self, duplicates, candidates, duration):
+        """Record the outcome of the selection in a duplicate set, if events are
+        streamed.
+        """
+        if not self.events:
+            return
+        event = {
+            "event": "duplicate_set",
+            "time": time.time(),
+            "hash": duplicates.hash_key,
+            "size": duplicates.size,
+            "decision": duplicates.decision,
+            "selected": sorted((list(mail.uid) for mail in candidates or ()), key=str),
+            "diff_comparisons": duplicates.metrics["diff_comparisons"],
+            "duration": duration,
+        }
+        self.events.write(json.dumps(event) + "\n")
+
+    def select_all(self):
+        """Gather the final selection of mails from each duplicate set.
+
+        We apply the selection strategy one duplicate set at a time to keep memory
+        footprint low and make the log easier to read.
+        """
+        with self.timed("select", "mail_retained"):
+            for candidates in self.iter_selection():
                 self.selection.update(candidates)
 
+    def stream_selection(self):
+        """Yields selected mails one duplicate set at a time.
+
+        Nothing is retained once a mail has been consumed, so memory footprint is
+        bounded by the biggest duplicate set instead of the whole selection.
+        """
+        for candidates in self.iter_selection():
+            for mail in candidates:
+                yield mail
+
     def close_all(self):
-        """ Close all open boxes. """
+        """ Close all open boxes, and the stream of events. """
         for source_path, box in self.sources.items():
             logger.debug(f"Close {source_path}")
             box.close()
+        self.close_events()
+
+    def close_events(self):
+        """Flush and close the stream of events, if any."""
+        if self.events:
+            self.events.close()
 
     def report(self):
         """ Returns a text report of user-friendly statistics and metrics. """
+        from tabulate import tabulate
+
         output = ""
         for prefix, title in (("mail_", "Mails"), ("set_", "Duplicate sets")):
             table = [[title, "Metric", "Description"]]
@@ -442,6 +1004,84 @@ class Deduplicate:
             output += "\n"
         return output
 
+    def performance_report(self):
+        """Returns a text report of performance metrics and timings of each phase."""
+        from tabulate import tabulate
+
+        output = ""
+        table = [["Performances", "Metric", "Description"]]
+        for metric_id, desc in METRICS_DEF.items():
+            table.append(
+                [
+                    metric_id.replace("_", " ").capitalize(),
+                    self.metrics[metric_id],
+                    "\n".join(textwrap.wrap(desc, 60)),
+                ]
+            )
+        output += tabulate(table, tablefmt="fancy_grid", headers="firstrow")
+        output += "\n"
+
+        if self.timings:
+            table = [
+                [
+                    "Phases",
+                    "Wall time",
+                    "CPU time",
+                    "Mails",
+                    "Mails/s",
+                    "Peak memory growth",
+                ]
+            ]
+            for phase_id, timing in self.timings.items():
+                throughput = timing["mails_per_second"]
+                growth = timing["peak_rss_growth"]
+                table.append(
+                    [
+                        PHASES_DEF[phase_id],
+                        f"{timing['wall_time']:.3f} s",
+                        f"{timing['cpu_time']:.3f} s",
+                        timing["mails"],
+                        "-" if throughput is None else f"{throughput:.1f}",
+                        "-" if growth is None else f"{growth / 2 ** 20:.1f} MiB",
+                    ]
+                )
+            output += tabulate(table, tablefmt="fancy_grid", headers="firstrow")
+            output += "\n"
+        return output
+
+    def profile_report(self):
+        """Returns a text report of the hottest functions of each profiled phase."""
+        from tabulate import tabulate
+
+        table = [["Phase", "Function", "Calls", "Own time", "Cumulative time"]]
+        for phase_id, hotspots in self.hotspots.items():
+            for hotspot in hotspots:
+                table.append(
+                    [
+                        PHASES_DEF[phase_id],
+                        hotspot["function"],
+                        hotspot["calls"],
+                        f"{hotspot['own_time']:.3f} s",
+                        f"{hotspot['cumulative_time']:.3f} s",
+                    ]
+                )
+        return tabulate(table, tablefmt="fancy_grid", headers="firstrow") + "\n"
+
+    def summary(self):
+        """Returns statistics, performance metrics and timings of each phase."""
+        return {
+            "stats": {stat_id: self.stats[stat_id] for stat_id in STATS_DEF},
+            "metrics": {
+                metric_id: self.metrics[metric_id] for metric_id in METRICS_DEF
+            },
+            "timings": self.timings,
+            "hotspots": self.hotspots,
+        }
+
+    def json_report(self):
+        """Returns a machine-readable report, as a JSON document."""
+        return json.dumps(self.summary(), indent=2)
+
     def check_stats(self):
         """Perform some high-level consistency checks on metrics.
 
@@ -0,0 +1,144 @@
+# Copyright Kevin Deldycke <kevin@deldycke.com> and contributors.
+# All Rights Reserved.
+#
+# This program is Free Software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+""" Persistent index of mail hashes, to make repeated runs incremental. """
+
+import hashlib
+import os
+import sqlite3
+
+from boltons.cacheutils import cachedproperty
+
+from . import logger
+from .colorize import choice_style
+from .mail import NORMALIZATION_VERSION, mail_path, mail_stat
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS mails (
+        source_path TEXT NOT NULL,
+        mail_id TEXT NOT NULL,
+        mtime INTEGER NOT NULL,
+        ctime INTEGER NOT NULL,
+        file_size INTEGER NOT NULL,
+        fingerprint TEXT NOT NULL,
+        digest BLOB,
+        size INTEGER,
+        timestamp,
+        rejection TEXT,
+        PRIMARY KEY (source_path, mail_id)
+    );
+    CREATE TEMPORARY TABLE seen (
+        source_path TEXT NOT NULL,
+        mail_id TEXT NOT NULL,
+        PRIMARY KEY (source_path, mail_id)
+    );
+"""
+
+
+class HashIndex:
+
+    """On-disk index of hashes and metadata computed from mails.
+
+    Entries are tied to the state of the mail file on the filesystem (modification
+    time, change time and size), and to a fingerprint of the configuration and code
+    used to produce the hash. An entry is only reused if all of these match.
+
+    For file-based boxes (mbox & co.), the state of the whole box file is considered,
+    so any change to the box invalidates all its mails.
+    """
+
+    def __init__(self, path, conf):
+        self.path = path
+        self.conf = conf
+
+        # Cache the state of file-based boxes, shared by all their mails.
+        self.box_stats = {}
+
+        # State of the mails looked-up but not found in the index yet.
+        self.pending = {}
+
+        logger.info(f"Open hash index at {choice_style(str(path))} ...")
+        self.db = sqlite3.connect(str(path))
+        self.db.executescript(SCHEMA)
+
+        # Invalidate entries computed with other settings or older code.
+        purged = self.db.execute(
+            "DELETE FROM mails WHERE fingerprint != ?", (self.fingerprint,)
+        ).rowcount
+        if purged:
+            logger.info(f"{purged} outdated entries purged from the index.")
+
+    @cachedproperty
+    def fingerprint(self):
+        """Hash of all parameters affecting the computation of indexed metadata."""
+        params = [
+            f"v{NORMALIZATION_VERSION}",
+            self.conf.hash_algorithm,
+            self.conf.time_source,
+        ]
+        params.extend(self.conf.hash_headers)
+        return hashlib.sha224("\n".join(map(str, params)).encode("utf-8")).hexdigest()
+
+    def file_state(self, box, mail_id):
+        """Returns the ``(mtime, ctime, size)`` state of the file holding a mail."""
+        location = mail_path(box, mail_id)
+        if location == box._path:
+            stat = self.box_stats.get(location)
+            if stat is None:
+                stat = self.box_stats[location] = os.stat(location)
+            # Narrow down the size to the mail's slice of the box.
+            start, stop = box._toc[mail_id][:2]
+            return stat.st_mtime_ns, stat.st_ctime_ns, stop - start
+        return mail_stat(box, mail_id)
+
+    def get(self, box, mail_id):
+        """Returns the indexed metadata of a mail, or ``None`` if not up to date.
+
+        Metadata are returned as a ``(digest, size, timestamp, rejection)`` tuple.
+        """
+        key = (box._path, str(mail_id))
+        self.db.execute("INSERT OR IGNORE INTO seen VALUES (?, ?)", key)
+        state = self.file_state(box, mail_id)
+        row = self.db.execute(
+            "SELECT digest, size, timestamp, rejection FROM mails "
+            "WHERE source_path = ? AND mail_id = ? AND mtime = ? AND ctime = ? "
+            "AND file_size = ?",
+            key + state,
+        ).fetchone()
+        if row is None:
+            self.pending[key] = state
+        return row
+
+    def put(self, box, mail_id, digest, size, timestamp, rejection):
+        """Index the metadata of a mail previously looked-up with ``get()``."""
+        key = (box._path, str(mail_id))
+        state = self.pending.pop(key)
+        self.db.execute(
+            "INSERT OR REPLACE INTO mails VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            key + state + (self.fingerprint, digest, size, timestamp, rejection),
+        )
+
+    def close(self):
+        """Prune entries of mails which disappeared from their boxes, and persist."""
+        pruned = self.db.execute(
+            "DELETE FROM mails WHERE source_path IN (SELECT source_path FROM seen) "
+            "AND NOT EXISTS (SELECT 1 FROM seen WHERE "
+            "seen.source_path = mails.source_path AND seen.mail_id = mails.mail_id)"
+        ).rowcount
+        logger.debug(f"{pruned} vanished mails pruned from the index.")
+        self.db.commit()
+        self.db.close()
@@ -16,18 +16,196 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
 import email
-import hashlib
 import inspect
+import logging
 import mailbox
 import os
 import re
 import time
+from functools import lru_cache
 
-import arrow
 from boltons.cacheutils import cachedproperty
-from tabulate import tabulate
 
-from . import CTIME, MINIMAL_HEADERS_COUNT, TooFewHeaders, logger
+from . import CTIME, HASH_ALGORITHMS, MINIMAL_HEADERS_COUNT, TooFewHeaders, logger
+
+# Version of the normalization heuristics implemented below. Must be bumped each time
+# a change produces different hashes or metadata, so persisted indexes gets
+# invalidated.
+NORMALIZATION_VERSION = 1
+
+# Number of distinct Date header values kept parsed in memory.
+DATE_CACHE_SIZE = 2 ** 16
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_date(value):
+    """Parse a Date header value into a ``(utc_day, timestamp)`` tuple.
+
+    ``utc_day`` is the ``YYYY-MM-DD`` day of the date in UTC and ``timestamp`` its
+    epoch. Both are ``None`` if the value can't be parsed.
+
+    Results are cached, as copies of a mail share the exact same Date header.
+    """
+    # Deferred to the first date parsed, to keep start-up fast.
+    import arrow
+
+    try:
+        parsed = email.utils.parsedate_tz(value)
+        if not parsed:
+            raise TypeError
+        timestamp = email.utils.mktime_tz(parsed)
+        return arrow.get(timestamp).format("YYYY-MM-DD"), timestamp
+    except (TypeError, ValueError):
+        return None, None
+
+
+def mail_path(box, mail_id):
+    """Returns the real filesystem location of a mail.
+
+    That's the individual mail's file for folder-based boxes (maildir & co.), but the
+    whole box path for file-based boxes (mbox & co.).
+
+    Location is derived from the table of contents the box maintains, so no file is
+    opened and no directory is listed in the process.
+    """
+    if isinstance(box, mailbox.Maildir):
+        try:
+            subpath = box._toc[mail_id]
+        except KeyError:
+            # Let the box refresh its table of contents.
+            subpath = box._lookup(mail_id)
+        return os.path.join(box._path, subpath)
+    if isinstance(box, mailbox.MH):
+        return os.path.join(box._path, str(mail_id))
+    return box._path
+
+
+def mail_stat(box, mail_id):
+    """Returns the ``(mtime_ns, ctime_ns, size)`` state of the file holding a mail.
+
+    Reuse the state collected by boxes indexing their content with a native reader.
+    Falls back to a ``stat`` call on the mail location.
+    """
+    stats = getattr(box, "_stats", None)
+    if stats:
+        state = stats.get(mail_id)
+        if state is not None:
+            return state
+    stat = os.stat(mail_path(box, mail_id))
+    return stat.st_mtime_ns, stat.st_ctime_ns, stat.st_size
+
+
+# Subject prefixes added by mailing list software.
+SUBJECT_PREFIXES = re.compile(r"([Rr]e: )*(\[\w[\w_-]+\w\] )+(.+)", re.DOTALL)
+
+# Header values made of a single bracketed address.
+BRACKETED_ADDRESS = re.compile(r"^<[^<>,]+>$")
+
+
+class HeaderNormalizer:
+
+    """Normalize and clean-up header values into their canonical form.
+
+    Normalization rule of each header is resolved once at instantiation, so values
+    are dispatched straight to their rule instead of going through a chain of tests.
+    """
+
+    def __init__(self, header_ids):
+        # Table of rules specific to some headers.
+        rules = {
+            "subject": self.normalize_subject,
+            "content-type": self.normalize_content_type,
+            "date": self.normalize_date,
+            "to": self.normalize_address,
+            "message-id": self.normalize_address,
+        }
+        self.rules = {header_id: rules.get(header_id) for header_id in header_ids}
+
+    def normalize(self, header_id, value):
+        """Returns the canonical form of a header value, as a unicode string."""
+        # Problematic when reading utf8 emails
+        # this will ensure value is always string
+        if isinstance(value, bytes):
+            value = value.decode("utf-8", "replace")
+        elif isinstance(value, email.header.Header):
+            value = str(value)
+
+        # Normalize white spaces. Splitting on whitespaces is much faster than a
+        # regular expression, and leave already normalized values untouched.
+        value = " ".join(value.split())
+
+        rule = self.rules.get(header_id)
+        if rule is None:
+            return value
+        return rule(value)
+
+    @staticmethod
+    def normalize_subject(value):
+        """Trim Subject prefixes automatically added by mailing list software.
+
+        The mail could have been cc'd to multiple lists, in which case it will
+        receive a different prefix for each, but this shouldn't be treated as a real
+        difference between duplicate mails.
+        """
+        subject = value
+        while "[" in subject:
+            matching = SUBJECT_PREFIXES.match(subject)
+            if not matching:
+                break
+            subject = matching.group(3)
+        return subject
+
+    @staticmethod
+    def normalize_content_type(value):
+        """Only keep the MIME type of the content.
+
+        Apparently list servers actually munge Content-Type e.g. by stripping the
+        quotes from charset="us-ascii". Section 5.1 of RFC2045 says that either form
+        is valid (and they are equivalent).
+
+        Additionally, with multipart/mixed, boundary delimiters can vary by
+        recipient. We need to allow for duplicates coming from multiple recipients,
+        since for example you could be signed up to the same list twice with
+        different addresses. Or maybe someone bounces you a load of mail some of
+        which is from a mailing list you're both subscribed to - then it's still
+        useful to be able to eliminate duplicates.
+        """
+        return value.partition(";")[0]
+
+    @staticmethod
+    def normalize_date(value):
+        """Only honour the date and normalize it to UTC timezone.
+
+        Date timestamps can differ by seconds or hours for various reasons.
+        """
+        day = parse_date(value)[0]
+        if day is None:
+            return value
+        return day
+
+    @staticmethod
+    def normalize_address(value):
+        """Strip the <> brackets around a single address.
+
+        Sometimes email.parser strips the <> brackets from a To: header which has a
+        single address. I have seen this happen for only one mail in a duplicate
+        pair. I'm not sure why (presumably the parser uses email.utils.unquote
+        somewhere in its code path which was only triggered by that mail and not its
+        sister mail), but to be safe, we should always strip the <> brackets to
+        avoid this difference preventing duplicate detection.
+        """
+        if value.startswith("<") and BRACKETED_ADDRESS.match(value):
+            return email.utils.unquote(value)
+        return value
+
+
+@lru_cache(maxsize=None)
+def header_normalizer(header_ids):
+    """Returns the normalizer of the provided tuple of header IDs.
+
+    Normalizers are built once per process and shared by all mails.
+    """
+    return HeaderNormalizer(header_ids)
 
 
 class DedupMail:
@@ -66,11 +244,9 @@ class DedupMail:
         # Mail ID used to uniquely refers to it in the context of its source.
         self.mail_id = None
 
-        # Real filesystem location of the mail. Returns the individual mail's file
-        # for folder-based box types (maildir & co.), but returns the whole box path
-        # for file-based boxes (mbox & co.). Only used by regexp-based selection
-        # strategies.
-        self.path = None
+        # Box this message originates from. Used to resolve the real filesystem
+        # location of the mail, on demand.
+        self.box = None
 
         # Global config.
         self.conf = None
@@ -85,11 +261,7 @@ class DedupMail:
         """
         self.source_path = box._path
         self.mail_id = mail_id
-
-        # Extract file name and close it right away to reclaim memory.
-        mail_file = box.get_file(mail_id)
-        self.path = mail_file._file.name
-        mail_file.close()
+        self.box = box
 
     def __repr__(self):
         return f"<{self.__class__.__name__} {self.source_path}:{self.mail_id}>"
@@ -99,6 +271,16 @@ class DedupMail:
         """Unique ID of the mail."""
         return self.source_path, self.mail_id
 
+    @cachedproperty
+    def path(self):
+        """Real filesystem location of the mail.
+
+        Returns the individual mail's file for folder-based box types (maildir & co.),
+        but returns the whole box path for file-based boxes (mbox & co.). Only used by
+        regexp-based selection strategies and the ``ctime`` time source.
+        """
+        return mail_path(self.box, self.mail_id)
+
     @cachedproperty
     def timestamp(self):
         """Compute the normalized canonical timestamp of the mail.
@@ -111,10 +293,15 @@ class DedupMail:
         # https://userprimary.net/posts/2007/11/18
         # /ctime-in-unix-means-last-change-time-not-create-time/
         if self.conf.time_source == CTIME:
-            return os.path.getctime(self.path)
+            return mail_stat(self.box, self.mail_id)[1] / 10 ** 9
 
-        # Fetch from the date header.
+        # Fetch from the date header. Whitespaces are normalized to share the
+        # parsing cache with the canonical headers.
         value = self.get("Date")
+        if isinstance(value, str):
+            timestamp = parse_date(" ".join(value.split()))[1]
+            if timestamp is not None:
+                return timestamp
         try:
             value = email.utils.mktime_tz(email.utils.parsedate_tz(value))
         except ValueError:
@@ -180,6 +367,13 @@ class DedupMail:
             body.extend(self.epilogue.splitlines(keepends=True))
         return body
 
+    @cachedproperty
+    def body_digest(self):
+        """Digest of the normalized body, to cheaply spot identical bodies."""
+        return HASH_ALGORITHMS[self.conf.hash_algorithm](
+            "".join(self.body_lines).encode("utf-8", "surrogatepass")
+        ).digest()
+
     @cachedproperty
     def subject(self):
         """Normalized subject.
@@ -192,18 +386,25 @@ class DedupMail:
         return subject
 
     @cachedproperty
-    def hash_key(self):
-        """ Returns the canonical hash of a mail. """
+    def digest(self):
+        """Returns the canonical hash of a mail, as raw bytes."""
         logger.debug(f"Serialized headers: {self.serialized_headers!r}")
-        hash_value = hashlib.sha224(self.serialized_headers).hexdigest()
-        logger.debug(f"Hash: {hash_value}")
-        return hash_value
+        hash_function = HASH_ALGORITHMS[self.conf.hash_algorithm]
+        digest = hash_function(self.serialized_headers).digest()
+        logger.debug(f"Hash: {digest.hex()}")
+        return digest
+
+    @property
+    def hash_key(self):
+        """Returns the canonical hash of a mail, as an hexadecimal string."""
+        return self.digest.hex()
 
     @cachedproperty
     def canonical_headers(self):
         """Returns the full list of all canonical headers names and values in
         preparation for hashing."""
         canonical_headers = []
+        normalizer = header_normalizer(self.conf.hash_headers)
 
         for header_id in self.conf.hash_headers:
 
@@ -214,8 +415,8 @@ class DedupMail:
             # Fetch all occurrences of the header.
             canonical_values = []
             for header_value in self.get_all(header_id):
-                normalized_value = self.normalize_header_value(header_id, header_value)
-                if re.search(r"\S", normalized_value):
+                normalized_value = normalizer.normalize(header_id, header_value)
+                if normalized_value and not normalized_value.isspace():
                     canonical_values.append(normalized_value)
             canonical_value = "\n".join(canonical_values)
 
@@ -231,6 +432,8 @@ class DedupMail:
 
         Returns a string ready for printing to the user or for debugging.
         """
+        from tabulate import tabulate
+
         table = [["Header ID", "Header value"]] + list(self.canonical_headers)
         return "\n" + tabulate(table, tablefmt="fancy_grid", headers="firstrow")
 
@@ -244,7 +447,7 @@ class DedupMail:
             raise TooFewHeaders(
                 f"{headers_count} headers found out of {MINIMAL_HEADERS_COUNT}."
             )
-        else:
+        elif logger.isEnabledFor(logging.DEBUG):
             logger.debug(self.pretty_canonical_headers)
 
         return "\n".join(
@@ -257,70 +460,103 @@ class DedupMail:
 
         Always returns a unicode string.
         """
-        # Problematic when reading utf8 emails
-        # this will ensure value is always string
-        if isinstance(value, bytes):
-            value = value.decode("utf-8", "replace")
-        elif isinstance(value, email.header.Header):
-            value = str(value)
+        return header_normalizer((header_id,)).normalize(header_id, value)
 
-        # Normalize white spaces.
-        value = re.sub(r"\s+", " ", value).strip()
-
-        # Trim Subject prefixes automatically added by mailing list software,
-        # since the mail could have been cc'd to multiple lists, in which case
-        # it will receive a different prefix for each, but this shouldn't be
-        # treated as a real difference between duplicate mails.
-        if header_id == "subject":
-            subject = value
-            while True:
-                matching = re.match(
-                    r"([Rr]e: )*(\[\w[\w_-]+\w\] )+(.+)", subject, re.DOTALL
-                )
-                if not matching:
-                    break
-                subject = matching.group(3)
-                # show_progress("Trimmed Subject to %s" % subject)
-            return subject
-
-        if header_id == "content-type":
-            # Apparently list servers actually munge Content-Type
-            # e.g. by stripping the quotes from charset="us-ascii".
-            # Section 5.1 of RFC2045 says that either form is valid
-            # (and they are equivalent).
-            #
-            # Additionally, with multipart/mixed, boundary delimiters can
-            # vary by recipient.  We need to allow for duplicates coming
-            # from multiple recipients, since for example you could be
-            # signed up to the same list twice with different addresses.
-            # Or maybe someone bounces you a load of mail some of which is
-            # from a mailing list you're both subscribed to - then it's
-            # still useful to be able to eliminate duplicates.
-            return re.sub(";.*", "", value)
-
-        if header_id == "date":
-            # Date timestamps can differ by seconds or hours for various
-            # reasons, so let's only honour the date for now and normalize them
-            # to UTC timezone.
-            try:
-                parsed = email.utils.parsedate_tz(value)
-                if not parsed:
-                    raise TypeError
-                utc_timestamp = email.utils.mktime_tz(parsed)
-                return arrow.get(utc_timestamp).format("YYYY-MM-DD")
-            except (TypeError, ValueError):
-                return value
-
-        elif header_id in ["to", "message-id"]:
-            # Sometimes email.parser strips the <> brackets from a To:
-            # header which has a single address.  I have seen this happen
-            # for only one mail in a duplicate pair.  I'm not sure why
-            # (presumably the parser uses email.utils.unquote somewhere in
-            # its code path which was only triggered by that mail and not
-            # its sister mail), but to be safe, we should always strip the
-            # <> brackets to avoid this difference preventing duplicate
-            # detection.
-            if re.match("^<[^<>,]+>$", value):
-                return email.utils.unquote(value)
 
-        return value
+class MailRecord:
+
+    """Compact reference to a mail, as produced by the hashing phase.
+
+    Only carries the identity of the mail, its binary hash digest and the metadata
+    used by the selection strategies. The full ``DedupMail`` is re-read from its box
+    on demand, i.e. when a duplicate set needs to compare bodies or when the mail is
+    exported. It is kept around until ``release()`` is called.
+    """
+
+    __slots__ = (
+        "box",
+        "mail_id",
+        "digest",
+        "timestamp",
+        "conf",
+        "_path",
+        "_size",
+        "_message",
+    )
+
+    def __init__(self, box, mail_id, digest, conf, timestamp, size=None):
+        # Box this mail originates from.
+        self.box = box
+
+        # Mail ID used to uniquely refers to it in the context of its box.
+        self.mail_id = mail_id
+
+        # Binary digest of the canonical hash of the mail.
+        self.digest = digest
+
+        # Global config.
+        self.conf = conf
+
+        # Metadata used by selection strategies.
+        self.timestamp = timestamp
+
+        # File location is only resolved if a strategy asks for it.
+        self._path = None
+
+        # Body size is lazily computed from the full message if not known yet.
+        self._size = size
+        self._message = None
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.source_path}:{self.mail_id}>"
+
+    @property
+    def source_path(self):
+        """Normalized path to the mailbox this mail originates from."""
+        return self.box._path
+
+    @property
+    def uid(self):
+        """Unique ID of the mail."""
+        return self.source_path, self.mail_id
+
+    @property
+    def hash_key(self):
+        """Canonical hash of the mail, as an hexadecimal string."""
+        return self.digest.hex()
+
+    @property
+    def path(self):
+        """Real filesystem location of the mail, derived from its box."""
+        if self._path is None:
+            self._path = mail_path(self.box, self.mail_id)
+        return self._path
+
+    @property
+    def message(self):
+        """Full ``DedupMail`` instance, re-read from its box."""
+        if self._message is None:
+            logger.debug(f"Load {self!r} from its box.")
+            mail = self.box[self.mail_id]
+            mail.add_box_metadata(self.box, self.mail_id)
+            mail.conf = self.conf
+            self._message = mail
+        return self._message
+
+    def release(self):
+        """Drop the full message to reclaim memory."""
+        self._message = None
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = self.message.size
+        return self._size
+
+    @property
+    def body_lines(self):
+        return self.message.body_lines
+
+    @property
+    def body_digest(self):
+        return self.message.body_digest
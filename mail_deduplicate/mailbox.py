@@ -16,8 +16,19 @@
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
 import inspect
+import io
 import mailbox
+import mmap
+import os
+import re
+import shutil
+import sys
+import time
+import zlib
+from array import array
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from functools import partial
+from stat import S_ISDIR
 from pathlib import Path
 
 from boltons.dictutils import FrozenDict
@@ -25,13 +36,779 @@ from boltons.iterutils import flatten
 
 from . import logger
 from .colorize import choice_style
-from .mail import DedupMail
+from .mail import DedupMail, mail_path
+
+# Not available on Windows.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 """ Patch and tweak Python's standard librabry mailboxes constructors to set
 sane defaults. Also forces out our own message factories to add deduplication
 tools and utilities. """
 
 
+# Linux ioctl request cloning the content of a file by reference. Other platforms
+# always copy files.
+FICLONE = None
+if fcntl and sys.platform.startswith("linux"):
+    FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
+
+
+def clone_file(path, target):
+    """Clone the content of the file at ``path`` to the opened ``target`` file.
+
+    Content is shared by reference on filesystems supporting it, else it is copied
+    byte for byte. Modification time is preserved.
+    """
+    with open(path, "rb") as source:
+        try:
+            if FICLONE is None:
+                raise OSError
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        except OSError:
+            shutil.copyfileobj(source, target, COPY_BUFFER_SIZE)
+        target.flush()
+        os.fsync(target.fileno())
+        stat = os.fstat(source.fileno())
+    os.utime(target.name, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+def sync_folders(folders):
+    """Persist the entries of folders."""
+    for folder in folders:
+        folder_fd = os.open(folder, os.O_RDONLY)
+        try:
+            os.fsync(folder_fd)
+        finally:
+            os.close(folder_fd)
+
+
+def remove_file(path):
+    """Remove a file. Returns ``False`` if it does not exist."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def with_mail_file(box, mail_id, operation):
+    """Call ``operation`` with the path of the file holding a mail of a maildir.
+
+    If the file is gone, it was probably renamed by another client since the table
+    of contents of the box was read. So it is read again, and ``operation`` retried
+    once.
+    """
+    try:
+        return operation(mail_path(box, mail_id))
+    except FileNotFoundError:
+        # Force a full read of the table of contents.
+        box._last_read = 0
+        box._refresh()
+        return operation(os.path.join(box._path, box._lookup(mail_id)))
+
+
+# Size of chunks used to copy files.
+COPY_BUFFER_SIZE = 1024 * 1024  # bytes
+
+# Maximum number of mails removed concurrently from folder-based boxes.
+REMOVAL_THREADS = 16
+
+
+class NativeMaildir(mailbox.Maildir):
+
+    """Maildir reader indexing its content with ``os.scandir``.
+
+    The standard library lists ``cur`` and ``new`` sub-folders, then stats each entry
+    to skip directories. We get the same table of contents out of a single ``stat``
+    call per entry, and keep the state of each mail file around. So later uses of
+    file metadata (``ctime`` time source, persistent index) do not need to hit the
+    filesystem again.
+
+    Mails are then located from that table of contents, without checking the
+    existence of their file first. The table of contents is only read again when a
+    file can't be found, as other clients might have renamed it since.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Map mail IDs to the ``(mtime_ns, ctime_ns, size)`` state of their file.
+        self._stats = {}
+
+    def _refresh(self):
+        """Update table of contents mapping and state of mail files.
+
+        Same as ``mailbox.Maildir._refresh()``, including its mtime-based shortcut.
+        """
+        if time.time() - self._last_read > 2 + self._skewfactor:
+            refresh = False
+            for subdir in self._toc_mtimes:
+                mtime = os.path.getmtime(self._paths[subdir])
+                if mtime > self._toc_mtimes[subdir]:
+                    refresh = True
+                self._toc_mtimes[subdir] = mtime
+            if not refresh:
+                return
+        toc = {}
+        stats = {}
+        for subdir in self._toc_mtimes:
+            with os.scandir(self._paths[subdir]) as entries:
+                for entry in entries:
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        # Dangling symlink, or mail moved since listed.
+                        continue
+                    if S_ISDIR(stat.st_mode):
+                        continue
+                    uniq = entry.name.split(self.colon)[0]
+                    toc[uniq] = os.path.join(subdir, entry.name)
+                    stats[uniq] = stat.st_mtime_ns, stat.st_ctime_ns, stat.st_size
+        self._toc = toc
+        self._stats = stats
+        self._last_read = time.time()
+
+    def refresh_toc(self):
+        """Read the table of contents right away.
+
+        Later calls to ``_refresh()`` will only re-read the box if its sub-folders
+        were modified since, instead of unconditionally re-reading it within the next
+        2 seconds.
+        """
+        self._last_read = 0
+        self._refresh()
+        self._last_read = 0
+
+    def iterkeys(self):
+        """Return an iterator over keys."""
+        self._refresh()
+        yield from list(self._toc)
+
+    def _lookup(self, key):
+        """Use TOC to return subpath for given key, or raise a KeyError.
+
+        Unlike the standard library, the file is not checked for existence. The
+        table of contents is only refreshed for unknown keys.
+        """
+        try:
+            return self._toc[key]
+        except KeyError:
+            pass
+        self._refresh()
+        try:
+            return self._toc[key]
+        except KeyError:
+            raise KeyError(f"No message with key: {key}") from None
+
+    def _retry(self, method, key):
+        """Call ``method`` on the mail ``key``, and returns its result.
+
+        If the file of the mail is gone, it was probably renamed by another client,
+        so the table of contents is read again before a second attempt.
+        """
+        try:
+            return method(key)
+        except FileNotFoundError:
+            self.refresh_toc()
+            return method(key)
+
+    def get_message(self, key):
+        """Return a Message representation or raise a KeyError."""
+        return self._retry(self._get_message, key)
+
+    def _get_message(self, key):
+        """Same as ``mailbox.Maildir.get_message()``, but the date of the message is
+        taken from the state of its file collected with the table of contents."""
+        subpath = self._lookup(key)
+        with open(os.path.join(self._path, subpath), "rb") as mail_file:
+            if self._factory:
+                msg = self._factory(mail_file)
+            else:
+                msg = mailbox.MaildirMessage(mail_file)
+        subdir, name = os.path.split(subpath)
+        msg.set_subdir(subdir)
+        if self.colon in name:
+            msg.set_info(name.split(self.colon)[-1])
+        stat = self._stats.get(key)
+        if stat:
+            msg.set_date(stat[0] / 10 ** 9)
+        else:
+            msg.set_date(os.path.getmtime(os.path.join(self._path, subpath)))
+        return msg
+
+    def get_bytes(self, key):
+        """Return a bytes representation or raise a KeyError."""
+        return self._retry(super().get_bytes, key)
+
+    def get_file(self, key):
+        """Return a file-like representation or raise a KeyError."""
+        return self._retry(super().get_file, key)
+
+    def remove(self, key):
+        """Remove the keyed message; raise KeyError if it doesn't exist."""
+        self._retry(super().remove, key)
+        self._stats.pop(key, None)
+
+    def get_folder(self, folder):
+        """Return a native Maildir instance for the named folder."""
+        return self.__class__(
+            os.path.join(self._path, "." + folder), factory=self._factory, create=False
+        )
+
+    def add_batch(self, messages):
+        """Add a batch of messages and return their assigned keys.
+
+        Same as ``mailbox.Maildir.add()``, but all messages are first written to
+        ``tmp/``, then moved to their final sub-folder in one go. Directories
+        receiving the messages are synced once per batch.
+        """
+        tmp_paths = []
+        dests = []
+        keys = []
+        try:
+            for message in messages:
+                tmp_file = self._create_tmp()
+                tmp_paths.append(tmp_file.name)
+                try:
+                    self._dump_message(message, tmp_file)
+                    tmp_file.flush()
+                    os.fsync(tmp_file.fileno())
+                finally:
+                    tmp_file.close()
+                dests.append(self._destination(tmp_file.name, message))
+
+            for tmp_path, dest in zip(tmp_paths, dests):
+                keys.append(self._deliver(tmp_path, dest))
+        finally:
+            # Clean-up temporary files not moved to their final location.
+            for tmp_path in tmp_paths[len(keys) :]:
+                os.remove(tmp_path)
+
+        sync_folders({os.path.dirname(dest) for dest in dests})
+        return keys
+
+    def add_files(self, mails):
+        """Add a batch of messages from the files of other maildirs, byte for byte.
+
+        ``mails`` are ``(box, key)`` tuples locating each message in its maildir.
+        Files are hard-linked into the box if possible. Else they are cloned by
+        reflink on filesystems supporting it, or copied. Messages keep the sub-folder
+        and the info flags of their original file.
+
+        Returns the assigned keys.
+        """
+        keys = []
+        dests = []
+        for box, key in mails:
+            new_key, dest = with_mail_file(box, key, self._add_file)
+            keys.append(new_key)
+            dests.append(dest)
+
+        sync_folders({os.path.dirname(dest) for dest in dests})
+        return keys
+
+    def _add_file(self, path):
+        """Add a message from the file of another maildir.
+
+        Returns the assigned key and the final location of the message.
+        """
+        subdir = os.path.basename(os.path.dirname(path))
+        if subdir not in ("new", "cur"):
+            subdir = "new"
+        suffix = ""
+        name = os.path.basename(path)
+        if self.colon in name:
+            suffix = self.colon + name.split(self.colon, 1)[1]
+
+        # Reserve a unique name in tmp/ the standard way.
+        tmp_file = self._create_tmp()
+        uniq = os.path.basename(tmp_file.name).split(self.colon)[0]
+        dest = os.path.join(self._path, subdir, uniq + suffix)
+        try:
+            os.link(path, dest)
+            return uniq, dest
+        except FileExistsError:
+            raise mailbox.ExternalClashError(
+                f"Name clash with existing message: {dest}"
+            )
+        except OSError:
+            # Not on the same filesystem, or hard links not supported.
+            clone_file(path, tmp_file)
+            tmp_file.close()
+            return self._deliver(tmp_file.name, dest), dest
+        finally:
+            tmp_file.close()
+            # Release the reserved name, if not already delivered.
+            try:
+                os.remove(tmp_file.name)
+            except FileNotFoundError:
+                pass
+
+    def _deliver(self, tmp_path, dest):
+        """Move a message from ``tmp/`` to its final location and returns its key.
+
+        Never overwrites an existing message, as the standard library does, unless
+        the filesystem does not support hard links.
+        """
+        try:
+            os.link(tmp_path, dest)
+        except FileExistsError:
+            raise mailbox.ExternalClashError(
+                f"Name clash with existing message: {dest}"
+            )
+        except (AttributeError, PermissionError):
+            # No hard links on this filesystem: fall back to the standard library's
+            # rename.
+            os.rename(tmp_path, dest)
+        else:
+            os.remove(tmp_path)
+        return os.path.basename(dest).split(self.colon)[0]
+
+    def remove_batch(self, keys, threads=REMOVAL_THREADS):
+        """Remove a batch of messages, with concurrent unlinks.
+
+        Messages whose file is gone are removed last, from a fresh table of
+        contents, as they were probably renamed by another client.
+        """
+        paths = [os.path.join(self._path, self._lookup(key)) for key in keys]
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            missing = [
+                key
+                for key, removed in zip(keys, executor.map(remove_file, paths))
+                if not removed
+            ]
+        if missing:
+            self.refresh_toc()
+            for key in missing:
+                os.remove(os.path.join(self._path, self._lookup(key)))
+        for key in keys:
+            self._toc.pop(key, None)
+            self._stats.pop(key, None)
+
+    def _destination(self, tmp_path, message):
+        """Returns the final location of a message written to ``tmp_path``.
+
+        Also sets the modification time of the file to the date of the message.
+        """
+        subdir = "new"
+        suffix = ""
+        if isinstance(message, mailbox.MaildirMessage):
+            subdir = message.get_subdir()
+            suffix = self.colon + message.get_info()
+            if suffix == self.colon:
+                suffix = ""
+            os.utime(tmp_path, (time.time(), message.get_date()))
+        uniq = os.path.basename(tmp_path).split(self.colon)[0]
+        return os.path.join(self._path, subdir, uniq + suffix)
+
+
+# Suffix of the sidecar files caching the table of contents of file-based boxes.
+TOC_CACHE_SUFFIX = ".mdedup-toc"
+
+# Version of the TOC cache file format.
+TOC_CACHE_VERSION = 1
+
+# Boxes smaller than this are always scanned, as it costs less than maintaining a
+# sidecar file.
+TOC_CACHE_MIN_SIZE = 16 * 1024 * 1024  # bytes
+
+# Length of the end of box checked to make sure it was only appended to.
+TOC_CACHE_TAIL = 4096  # bytes
+
+
+class AppendBuffer(io.BytesIO):
+
+    """In-memory buffer of content to be appended to a file.
+
+    Reports positions as if the content was already written at the end of the file,
+    so the standard library can compute the boundaries of the messages it renders.
+    """
+
+    def __init__(self, offset):
+        super().__init__()
+        self.offset = offset
+
+    def tell(self):
+        return self.offset + super().tell()
+
+
+# Empty line separating headers from the body of a mail. Lines made of whitespaces
+# only are continuations of folded headers, as the ``email`` parser reads them.
+HEADERS_END = re.compile(rb"\n\r?\n")
+
+# Lines ending headers when reading a mail line by line.
+HEADERS_END_LINES = frozenset((b"\n", b"\r\n"))
+
+
+def find_line(data, prefix, pos=0):
+    """Returns the position of the first line of ``data`` starting with ``prefix``.
+
+    Search starts at ``pos``, which is expected to be the start of a line. Returns
+    ``-1`` if not found.
+    """
+    while True:
+        pos = data.find(prefix, pos)
+        if pos <= 0 or data[pos - 1] == ord("\n"):
+            return pos
+        pos += 1
+
+
+class MappedBox:
+
+    """Memory-mapped reader for file-based boxes.
+
+    The table of contents is built by searching message separators in the mapped
+    file with ``find()``, instead of reading it line by line in Python. Messages and
+    headers are then sliced out of the map on demand.
+
+    Tables of contents of big boxes are persisted in a sidecar file, tied to the
+    inode, size and modification time of the box. An unchanged box is not scanned
+    again. A box which only grew is scanned from its last known message.
+
+    Meant to be mixed with ``mailbox.mbox`` and ``mailbox.MMDF``. Falls back to the
+    standard library implementation on platforms not using ``\\n`` line separators.
+    """
+
+    _map = None
+
+    # Length of the separator preceding the start of each message.
+    _separator_length = 0
+
+    def _mapped(self, stop=0):
+        """Returns a read-only map of the box file, covering at least up to ``stop``.
+
+        The box file is re-mapped if it grew past the current map.
+        """
+        if self._map is None or len(self._map) < stop:
+            self._unmap()
+            self._file.flush()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _generate_toc(self):
+        """Generate key-to-(start, stop) table of contents."""
+        self._file.seek(0, 2)
+        length = self._file.tell()
+        if mailbox.linesep != b"\n":
+            return super()._generate_toc()
+        toc = []
+        if length:
+            data = self._mapped(length)
+            stat = os.fstat(self._file.fileno())
+            toc, resume = self._load_toc_cache(stat, data)
+            if resume is not None:
+                logger.debug(f"Scan {self._path} from offset {resume}.")
+                toc.extend(self._scan(data, length, resume))
+                self._save_toc_cache(stat, data, toc)
+        self._toc = dict(enumerate(toc))
+        self._next_key = len(self._toc)
+        self._file_length = length
+
+    @property
+    def _toc_cache_path(self):
+        return f"{self._path}{TOC_CACHE_SUFFIX}"
+
+    def _toc_cache_header(self, stat, data, size):
+        """Identify the state of the box file and the format of its cached TOC."""
+        tail = data[max(size - TOC_CACHE_TAIL, 0) : size]
+        return [
+            TOC_CACHE_VERSION,
+            zlib.crc32(self.__class__.__name__.encode()),
+            stat.st_ino,
+            size,
+            stat.st_mtime_ns,
+            zlib.crc32(tail),
+        ]
+
+    def _load_toc_cache(self, stat, data):
+        """Load the cached table of contents of the box.
+
+        Returns the ``(toc, resume)`` tuple, where ``toc`` is the list of ``(start,
+        stop)`` boundaries of messages known to be up to date, and ``resume`` the
+        offset from which the rest of the box has to be scanned. ``resume`` is
+        ``None`` if the cached table of contents is complete.
+        """
+        if stat.st_size < TOC_CACHE_MIN_SIZE:
+            return [], 0
+        cached = array("q")
+        try:
+            with open(self._toc_cache_path, "rb") as cache_file:
+                cached.frombytes(cache_file.read())
+        except OSError:
+            return [], 0
+        header = cached[:6].tolist()
+        if len(header) < 6 or len(cached) % 2:
+            return [], 0
+        size = header[3]
+        bounds = cached[6:]
+        toc = list(zip(bounds[::2], bounds[1::2]))
+        current = self._toc_cache_header(stat, data, size)
+
+        # Box is unchanged.
+        if size == stat.st_size and header == current:
+            return toc, None
+
+        # Box only grew: all fields but its modification time match. Last message
+        # might have been extended by new content, so scan again from its start.
+        del header[4], current[4]
+        if size < stat.st_size and header == current and toc:
+            return toc, toc.pop()[0] - self._separator_length
+
+        logger.debug(f"Discard outdated {self._toc_cache_path}")
+        return [], 0
+
+    def _save_toc_cache(self, stat, data, toc):
+        """Persist the table of contents of the box in its sidecar file."""
+        if stat.st_size < TOC_CACHE_MIN_SIZE:
+            return
+        cached = array("q", self._toc_cache_header(stat, data, stat.st_size))
+        for start, stop in toc:
+            cached.append(start)
+            cached.append(stop)
+        temp_path = f"{self._toc_cache_path}.{os.getpid()}"
+        try:
+            with open(temp_path, "wb") as cache_file:
+                cached.tofile(cache_file)
+            os.replace(temp_path, self._toc_cache_path)
+        except OSError as expt:
+            logger.debug(f"Can't write {self._toc_cache_path}: {expt}")
+
+    def _message_start(self, key, from_):
+        """Returns the ``(start, stop)`` boundaries of a message in the map.
+
+        Skips the first line of the message unless ``from_`` is set, as the standard
+        library does.
+        """
+        start, stop = self._lookup(key)
+        if not from_:
+            end_of_line = self._mapped(stop).find(b"\n", start, stop)
+            start = stop if end_of_line == -1 else end_of_line + 1
+        return start, stop
+
+    def get_bytes(self, key, from_=False):
+        """Return a string representation or raise a KeyError."""
+        if mailbox.linesep != b"\n":
+            return super().get_bytes(key, from_)
+        start, stop = self._message_start(key, from_)
+        return self._mapped(stop)[start:stop]
+
+    def get_file(self, key, from_=False):
+        """Return a file-like representation or raise a KeyError."""
+        if mailbox.linesep != b"\n":
+            return super().get_file(key, from_)
+        return io.BytesIO(self.get_bytes(key, from_))
+
+    def get_headers(self, key):
+        """Returns the raw headers of a message, without reading its body.
+
+        The end of headers is searched for directly in the map, and only headers are
+        copied out of it. The body of the message is never read.
+        """
+        start, stop = self._message_start(key, False)
+        data = self._mapped(stop)
+        # Start the search on the newline ending the first line, to catch headers
+        # made of a single empty line.
+        matching = HEADERS_END.search(data, max(start - 1, 0), stop)
+        end = matching.end() if matching else stop
+        return data[start:end]
+
+    def add_batch(self, messages):
+        """Add a batch of messages and return their assigned keys.
+
+        Same as ``mailbox.mbox.add()`` and ``mailbox.MMDF.add()``, but all messages
+        are rendered to memory then appended to the box file with a single write,
+        instead of seeking, writing and flushing the file for each of them.
+        """
+        self._lookup()
+        box_file = self._file
+        box_file.seek(0, 2)
+        buffer = AppendBuffer(box_file.tell())
+        keys = []
+        # Let the standard library render messages to our buffer.
+        self._file = buffer
+        try:
+            if not self._toc and not self._pending:
+                self._pre_mailbox_hook(buffer)
+            for message in messages:
+                self._pre_message_hook(buffer)
+                offsets = self._install_message(message)
+                self._post_message_hook(buffer)
+                keys.append((self._next_key + len(keys), offsets))
+        finally:
+            self._file = box_file
+        box_file.write(buffer.getvalue())
+        box_file.flush()
+        self._file_length = box_file.tell()
+        self._toc.update(keys)
+        self._next_key += len(keys)
+        # Messages were appended to the box file: syncing it is enough.
+        self._pending_sync = True
+        return [key for key, _ in keys]
+
+    def flush(self):
+        """Write any pending changes to disk."""
+        if not self._pending:
+            return super().flush()
+        if mailbox.linesep != b"\n":
+            # The box file is about to get replaced.
+            self._unmap()
+            return super().flush()
+        self._compact()
+        stat = os.fstat(self._file.fileno())
+        if stat.st_size:
+            toc = [self._toc[key] for key in sorted(self._toc)]
+            self._save_toc_cache(stat, self._mapped(stat.st_size), toc)
+
+    def _compact(self):
+        """Rewrite the box file with the remaining messages, in a single pass.
+
+        Same as ``mailbox._singlefileMailbox.flush()``, but messages are written
+        straight from the map with one call each, instead of being copied through
+        4 KB reads.
+        """
+        # Check length of the box file; if it's changed, some other process has
+        # modified the mailbox since we scanned it.
+        self._file.seek(0, 2)
+        cur_len = self._file.tell()
+        if cur_len != self._file_length:
+            raise mailbox.ExternalClashError(
+                f"Size of mailbox file changed (expected {self._file_length}, "
+                f"found {cur_len})"
+            )
+
+        new_file = mailbox._create_temporary(self._path)
+        try:
+            new_toc = {}
+            self._pre_mailbox_hook(new_file)
+            if self._toc:
+                data = memoryview(self._mapped(cur_len))
+                try:
+                    for key in sorted(self._toc):
+                        start, stop = self._toc[key]
+                        self._pre_message_hook(new_file)
+                        new_start = new_file.tell()
+                        new_file.write(data[start:stop])
+                        new_toc[key] = (new_start, new_file.tell())
+                        self._post_message_hook(new_file)
+                finally:
+                    data.release()
+            self._file_length = new_file.tell()
+        except BaseException:
+            new_file.close()
+            os.remove(new_file.name)
+            raise
+        mailbox._sync_close(new_file)
+
+        # Box file is about to get replaced.
+        self._unmap()
+        self._file.close()
+        # Make sure the new file's mode is the same as the old file's.
+        os.chmod(new_file.name, os.stat(self._path).st_mode)
+        os.replace(new_file.name, self._path)
+        self._file = open(self._path, "rb+")
+        self._toc = new_toc
+        self._pending = False
+        self._pending_sync = False
+        if self._locked:
+            mailbox._lock_file(self._file, dotlock=False)
+
+    def remove_batch(self, keys):
+        """Remove a batch of messages.
+
+        Removals are only recorded in the table of contents. The box file is
+        compacted once, on the next flush.
+        """
+        for key in keys:
+            self.remove(key)
+
+    def close(self):
+        """Flush and close the mailbox."""
+        try:
+            super().close()
+        finally:
+            self._unmap()
+
+
+class NativeMbox(MappedBox, mailbox.mbox):
+
+    """Memory-mapped mbox reader."""
+
+    @staticmethod
+    def _scan(data, length, pos=0):
+        """Returns ``(start, stop)`` boundaries of messages in the mapped ``data``,
+        from the ``pos`` offset.
+
+        Same heuristics as ``mailbox.mbox._generate_toc()``: a message starts on each
+        ``From`` line and stops at the previous line, or before the blank line
+        preceding it.
+        """
+        starts = []
+        stops = []
+        pos = find_line(data, b"From ", pos)
+        while pos != -1:
+            if starts:
+                # Previous line is blank.
+                if pos > 1 and data[pos - 2] == ord("\n"):
+                    stops.append(pos - 1)
+                else:
+                    stops.append(pos)
+            starts.append(pos)
+            pos = find_line(data, b"From ", pos + 1)
+        if starts:
+            if data[length - 1] == ord("\n") and (
+                length == 1 or data[length - 2] == ord("\n")
+            ):
+                stops.append(length - 1)
+            else:
+                stops.append(length)
+        return list(zip(starts, stops))
+
+
+class NativeMMDF(MappedBox, mailbox.MMDF):
+
+    """Memory-mapped MMDF reader."""
+
+    _separator_length = len(b"\001\001\001\001\n")
+
+    @staticmethod
+    def _scan(data, length, pos=0):
+        """Returns ``(start, stop)`` boundaries of messages in the mapped ``data``,
+        from the ``pos`` offset.
+
+        Same heuristics as ``mailbox.MMDF._generate_toc()``: messages are enclosed
+        between ``\\001\\001\\001\\001`` lines.
+        """
+        separator = b"\001\001\001\001\n"
+        toc = []
+        pos = find_line(data, separator, pos)
+        while pos != -1:
+            start = pos + len(separator)
+            end = find_line(data, separator, start)
+            if end == -1:
+                toc.append((start, length))
+                break
+            toc.append((start, end - 1))
+            pos = find_line(data, separator, end + len(separator))
+        return toc
+
+
+# Box classes to use in place of the standard library ones.
+NATIVE_READERS = FrozenDict(
+    {
+        mailbox.Maildir: NativeMaildir,
+        mailbox.mbox: NativeMbox,
+        mailbox.MMDF: NativeMMDF,
+    }
+)
+
+
 def build_box_constructors():
     """Build our own mail constructors for each mailbox format.
 
@@ -62,7 +839,9 @@ def build_box_constructors():
             )
 
             # Set our own custom factory and safety options to default constructor.
-            constructor = partial(klass, factory=factory_klass, create=False)
+            constructor = partial(
+                NATIVE_READERS.get(klass, klass), factory=factory_klass, create=False
+            )
 
             # Generates our own box_type_id for use in CLI parameters.
             box_type_id = klass.__name__.lower()
@@ -74,6 +853,14 @@ def build_box_constructors():
 BOX_TYPES = FrozenDict(build_box_constructors())
 
 
+def box_type_id(box):
+    """Returns the type ID of an opened box, as indexed in ``BOX_TYPES``."""
+    for klass in box.__class__.__mro__:
+        if klass.__name__.lower() in BOX_TYPES:
+            return klass.__name__.lower()
+    raise ValueError(f"Unsupported box {box!r}.")
+
+
 # Categorize each box type into its structure type.
 BOX_STRUCTURES = FrozenDict(
     {
@@ -85,6 +872,10 @@ BOX_STRUCTURES = FrozenDict(
 assert set(flatten(BOX_STRUCTURES.values())) == set(BOX_TYPES)
 
 
+# Maximum number of subfolders opened concurrently.
+SUBFOLDER_THREADS = 16
+
+
 # List of required sub-folders defining a properly structured maildir.
 MAILDIR_SUBDIRS = frozenset(("cur", "new", "tmp"))
 
@@ -172,19 +963,182 @@ def lock_box(box, force_unlock):
     return box
 
 
-def open_subfolders(box, force_unlock):
-    """Browse recursively the subfolder tree of a box.
+def open_folder(box, force_unlock):
+    """Lock a box, refresh its table of contents and list its direct subfolders.
 
-    Returns a list of opened and locked boxes, each for one subfolder.
+    Returns the list of subfolders as unlocked boxes.
     """
-    folder_list = [lock_box(box, force_unlock)]
+    lock_box(box, force_unlock)
+    if isinstance(box, NativeMaildir):
+        box.refresh_toc()
 
+    subfolders = []
     # Skip box types not supporting subfolders.
     if hasattr(box, "list_folders"):
         for folder_id in box.list_folders():
             logger.info(f"Opening subfolder {folder_id} ...")
-            folder_list += open_subfolders(box.get_folder(folder_id), force_unlock)
-    return folder_list
+            subfolders.append(box.get_folder(folder_id))
+    return subfolders
+
+
+def open_subfolders(box, force_unlock, threads=SUBFOLDER_THREADS):
+    """Browse recursively the subfolder tree of a box.
+
+    Subfolders are opened concurrently by a pool of ``threads``, as most of the time
+    is spent waiting on the filesystem.
+
+    Returns a list of opened and locked boxes, each for one subfolder. Boxes are
+    always sorted in the depth-first order of the tree, whatever the order in which
+    their opening completed.
+    """
+    # Map each box to its subfolders.
+    tree = {}
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = {executor.submit(open_folder, box, force_unlock): box}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                folder = pending.pop(future)
+                tree[folder] = future.result()
+                for subfolder in tree[folder]:
+                    future = executor.submit(open_folder, subfolder, force_unlock)
+                    pending[future] = subfolder
+
+    def depth_first(folder):
+        yield folder
+        for subfolder in tree[folder]:
+            yield from depth_first(subfolder)
+
+    return list(depth_first(box))
+
+
+def read_headers(box, mail_id):
+    """Read the raw headers of a mail, without loading its body.
+
+    Stops reading the mail file at the empty line separating the headers from the
+    body. For file-based boxes, the file is a view bounded to the mail boundaries
+    indexed by the box, so we never read beyond.
+
+    Returns the headers as bytes, empty line included.
+    """
+    if isinstance(box, MappedBox):
+        return box.get_headers(mail_id)
+    headers = []
+    mail_file = box.get_file(mail_id)
+    try:
+        for line in mail_file:
+            headers.append(line)
+            if line in HEADERS_END_LINES:
+                break
+    finally:
+        mail_file.close()
+    return b"".join(headers)
+
+
+# Boxes storing a From line at the start of each message.
+FROM_LINE_BOXES = (mailbox.mbox, mailbox.MMDF)
+
+# Number of messages added at once to boxes supporting batches.
+EXPORT_BATCH_SIZE = 256
+
+# Maximum size of raw messages buffered before being added to a box.
+EXPORT_BATCH_BYTES = 64 * 1024 * 1024  # bytes
+
+
+class BatchWriter:
+
+    """Add messages to a box by batches, if the box supports it.
+
+    A batch is written as soon as it holds ``batch_size`` messages, or its raw
+    messages weight ``batch_bytes``, so memory use stays bounded whatever the size
+    of mails.
+    """
+
+    def __init__(
+        self, box, batch_size=EXPORT_BATCH_SIZE, batch_bytes=EXPORT_BATCH_BYTES
+    ):
+        self.box = box
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_files = []
+        self.callbacks = []
+
+    def add(self, message, callback=None):
+        """Queue a message for addition to the box.
+
+        ``callback`` is called without argument once the message has been written.
+        """
+        self.pending.append(message)
+        if isinstance(message, (bytes, str)):
+            self.pending_bytes += len(message)
+        self.queued(callback)
+
+    def add_mail(self, mail, callback=None):
+        """Queue a mail from one of our sources for addition to the box.
+
+        Mails are never re-serialized from their parsed form. Mails moving from one
+        maildir to another are added by their file. Others are added from their raw
+        content, to which the box only adds its own envelope (like the ``From`` line
+        and escaping of ``mbox``). So mails are kept byte for byte.
+        """
+        if isinstance(self.box, NativeMaildir) and isinstance(
+            mail.box, mailbox.Maildir
+        ):
+            self.pending_files.append((mail.box, mail.mail_id))
+            self.queued(callback)
+            return
+        if isinstance(self.box, FROM_LINE_BOXES) and isinstance(
+            mail.box, FROM_LINE_BOXES
+        ):
+            # Keep the original From line of the mail.
+            raw = mail.box.get_bytes(mail.mail_id, from_=True)
+        else:
+            raw = mail.box.get_bytes(mail.mail_id)
+        self.add(raw, callback)
+
+    def queued(self, callback):
+        if callback:
+            self.callbacks.append(callback)
+        if (
+            len(self.pending) + len(self.pending_files) >= self.batch_size
+            or self.pending_bytes >= self.batch_bytes
+        ):
+            self.flush()
+
+    def flush(self):
+        """Write all pending messages to the box."""
+        if self.pending_files:
+            self.box.add_files(self.pending_files)
+            self.pending_files = []
+        if self.pending:
+            if hasattr(self.box, "add_batch"):
+                self.box.add_batch(self.pending)
+            else:
+                for message in self.pending:
+                    self.box.add(message)
+            self.pending = []
+            self.pending_bytes = 0
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def close(self):
+        """Write all pending messages and close the box."""
+        try:
+            self.flush()
+        finally:
+            self.box.close()
+
+
+def remove_batch(box, mail_ids):
+    """Remove a batch of mails from a box, at once if the box supports it."""
+    if hasattr(box, "remove_batch"):
+        box.remove_batch(mail_ids)
+    else:
+        for mail_id in mail_ids:
+            box.remove(mail_id)
 
 
 def create_box(path, box_type=False):
@@ -84,6 +84,14 @@ def invoke(runner):
     return _run
 
 
+def stats_report(output):
+    """Extract statistics from the report printed by the CLI.
+
+    Leaves out performances, as they vary from one run to another.
+    """
+    return output.split("● Phase #4")[1].split("◼ Performances")[0]
+
+
 class MailFactory:
 
     """Create fake mail messages to serve as unittest fixtures.
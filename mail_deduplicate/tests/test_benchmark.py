@@ -0,0 +1,114 @@
+# Copyright Kevin Deldycke <kevin@deldycke.com> and contributors.
+# All Rights Reserved.
+#
+# This program is Free Software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+import json
+import os
+from mailbox import Maildir, mbox
+
+import pytest
+from click.testing import CliRunner
+
+from ..benchmark import (
+    BENCHMARK_ACTIONS,
+    Corpus,
+    benchmark,
+    run_benchmark,
+    run_isolated,
+)
+
+
+@pytest.mark.parametrize("box_type", ["maildir", "mbox"])
+def test_corpus_generation(tmp_path, box_type):
+    """Corpora are deterministic and readable by the standard library."""
+    corpus = Corpus(mail_count=50, attachment_ratio=0.5, attachment_size=512)
+    manifest = corpus.write(tmp_path.joinpath("a"), box_type)
+    assert corpus.write(tmp_path.joinpath("b"), box_type) == manifest
+    assert manifest["mails"] == 50
+    assert manifest["duplicates"] == 15
+    assert manifest["unique"] == 35
+
+    box_class = Maildir if box_type == "maildir" else mbox
+    contents = []
+    for path in ("a", "b"):
+        box = box_class(str(tmp_path.joinpath(path)), create=False)
+        contents.append(sorted(box.get_bytes(key) for key in box.iterkeys()))
+        box.close()
+    assert contents[0] == contents[1]
+    assert len(contents[0]) == 50
+
+    # Another seed produces another corpus.
+    other = Corpus(mail_count=50, seed=1).write(tmp_path.joinpath("c"), box_type)
+    assert other["bytes"] != manifest["bytes"]
+
+
+def test_run_benchmark(tmp_path):
+    """All phases are timed, and duplicates are grouped as generated."""
+    corpus = Corpus(mail_count=40, body_size=256, attachment_size=256)
+    results = run_benchmark(corpus, workdir=str(tmp_path))
+
+    assert json.loads(json.dumps(results)) == results
+    assert results["startup_time"] > 0
+    assert len(results["runs"]) == 2 * len(BENCHMARK_ACTIONS)
+    for run in results["runs"]:
+        assert list(run["timings"]) == ["load", "hash", "select", "action"]
+        assert run["timings"]["hash"]["mails"] == 40
+        manifest = run["corpus"]
+        assert run["stats"]["set_total"] == (
+            manifest["unique"] + manifest["duplicate_sets"]
+        )
+        assert run["stats"]["set_deduplicated"] == manifest["duplicate_sets"]
+        assert run["peak_rss"] is None or run["peak_rss"] > 0
+
+    # Generated corpora are cleaned up.
+    assert not list(tmp_path.iterdir())
+
+
+def test_run_isolated():
+    """Runs happen in their own process, and their errors are reported."""
+    assert run_isolated(os.getpid) != os.getpid()
+    with pytest.raises(RuntimeError, match="ZeroDivisionError"):
+        run_isolated(divmod, 1, 0)
+
+
+def test_benchmark_cli(tmp_path):
+    output = tmp_path.joinpath("results.json")
+    result = CliRunner().invoke(
+        benchmark,
+        [
+            "--mails",
+            "20",
+            "--set-sizes",
+            "2:1,4:1",
+            "--box-type",
+            "mbox",
+            "--action",
+            "delete-selected",
+            "--output",
+            str(output),
+        ],
+    )
+    assert result.exit_code == 0
+    results = json.loads(output.read_text())
+    assert results["corpus"]["set_sizes"] == {"2": 1, "4": 1}
+    [run] = results["runs"]
+    # Unique mails are selected too.
+    assert run["stats"]["mail_deleted"] == (
+        run["corpus"]["unique"] + run["corpus"]["duplicate_sets"]
+    )
+
+    result = CliRunner().invoke(benchmark, ["--set-sizes", "1:10"])
+    assert result.exit_code == 2
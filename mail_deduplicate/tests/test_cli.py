@@ -15,13 +15,23 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
+import json
 import logging
-from mailbox import Maildir
+import pstats
+import subprocess
+import sys
+from mailbox import Maildir, mbox
 from pathlib import Path
 
 import pytest
+from click.testing import CliRunner
 
+from .. import __file__ as package_file
 from .. import __version__, logger
+from .. import cli
+from ..cli import mdedup
+from ..deduplicate import Deduplicate
+from .conftest import MailFactory, stats_report
 
 
 def test_real_fs():
@@ -52,6 +62,35 @@ def test_version(invoke):
     result = invoke("--version")
     assert result.exit_code == 0
     assert __version__ in result.output
+    # Profile of the environment.
+    assert "'fs_encoding'" in result.output
+
+
+# Modules slow to import, which are only loaded by the phases requiring them.
+DEFERRED_MODULES = (
+    "arrow",
+    "asyncio",
+    "boltons.ecoutils",
+    "cProfile",
+    "difflib",
+    "multiprocessing",
+    "pstats",
+    "sqlite3",
+    "tabulate",
+)
+
+
+def test_lazy_imports():
+    """Starting the CLI does not import modules it might not need."""
+    result = subprocess.run(
+        [sys.executable, "-c", "import sys, mail_deduplicate.cli; print(*sys.modules)"],
+        cwd=str(Path(package_file).parents[1]),
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    loaded = set(result.stdout.decode().split())
+    assert "mail_deduplicate.cli" in loaded
+    assert loaded.isdisjoint(DEFERRED_MODULES)
 
 
 def test_unknown_option(invoke):
@@ -97,3 +136,159 @@ def test_early_export_file_check(invoke, make_box, tmp_path):
     assert result.exit_code == 1
     assert result.output == ""
     assert str(result.exception) == str(file)
+
+
+@pytest.mark.parametrize("box_type", [Maildir, mbox])
+@pytest.mark.parametrize(
+    "options",
+    [
+        ["--jobs=3"],
+        ["--header-only"],
+        ["--jobs=3", "--header-only"],
+        ["--stream"],
+        ["--hash-algorithm=blake2b-128"],
+        ["--prefetch=4"],
+        ["--prefetch=4", "--header-only"],
+    ],
+)
+def test_processing_modes(invoke, make_box, box_type, options):
+    """Alternative processing modes produces the exact same statistics."""
+    box_path, _ = make_box(
+        box_type,
+        [
+            MailFactory(body="Hello I am a duplicate mail."),
+            MailFactory(body="Hello I am a duplicate mail."),
+            MailFactory(body="Hello I am a duplicate mail. Bigger."),
+            MailFactory(message_id="<unique@mail.nohost.com>"),
+        ],
+    )
+
+    reports = []
+    for mode_options in ([], options):
+        result = invoke(
+            *mode_options,
+            "--strategy=select-smallest",
+            "--action=delete-selected",
+            "--dry-run",
+            box_path,
+        )
+        assert result.exit_code == 0
+        reports.append(stats_report(result.output))
+
+    assert reports[0] == reports[1]
+
+
+@pytest.mark.parametrize("stream", [None, "--stream"])
+def test_json_report(make_box, tmp_path, stream):
+    """JSON report is the only content of the standard output, and each duplicate
+    set produces an event."""
+    box_path, _ = make_box(
+        Maildir,
+        [
+            MailFactory(body="Hello I am a duplicate mail."),
+            MailFactory(body="Hello I am a duplicate mail."),
+            MailFactory(body="Hello I am a duplicate mail. Bigger."),
+            MailFactory(message_id="<unique@mail.nohost.com>"),
+            MailFactory(message_id="<sizes@mail.nohost.com>", body="Small."),
+            MailFactory(message_id="<sizes@mail.nohost.com>", body="Big." * 200),
+        ],
+    )
+    events_path = tmp_path.joinpath("events.ndjson")
+    args = [
+        "--strategy=select-smallest",
+        "--action=delete-selected",
+        "--report-format=json",
+        f"--events={events_path}",
+        box_path,
+    ]
+    if stream:
+        args.insert(0, stream)
+    result = CliRunner(mix_stderr=False).invoke(mdedup, args)
+    assert result.exit_code == 0
+
+    report = json.loads(result.stdout)
+    assert report["stats"]["mail_found"] == 6
+    assert report["stats"]["mail_deleted"] == 3
+    assert report["stats"]["set_deduplicated"] == 1
+    assert report["stats"]["set_skipped_size"] == 1
+    assert report["metrics"]["biggest_set"] == 3
+    assert "hash" in report["timings"]
+    assert "Phase #4" in result.stderr
+
+    events = [json.loads(line) for line in events_path.read_text().splitlines()]
+    assert len(events) == 2
+    events.sort(key=lambda event: event["size"])
+    skipped, deduplicated = events
+    assert skipped["decision"] == "skipped_size"
+    assert skipped["selected"] == []
+    assert deduplicated["decision"] == "deduplicated"
+    assert deduplicated["size"] == 3
+    assert len(deduplicated["selected"]) == 2
+    for event in events:
+        assert event["event"] == "duplicate_set"
+        assert len(event["hash"]) == 56
+        assert event["duration"] >= 0
+
+
+def test_events_closed_on_early_exit(invoke, make_box, tmp_path, monkeypatch):
+    """Stream of events is closed even if the run stops before the action."""
+    box_path, _ = make_box(Maildir, [MailFactory(), MailFactory()])
+    instances = []
+
+    class TrackedDeduplicate(Deduplicate):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            instances.append(self)
+
+    monkeypatch.setattr(cli, "Deduplicate", TrackedDeduplicate)
+    events_path = tmp_path.joinpath("events.ndjson")
+    result = invoke(
+        "--hash-only",
+        "--action=delete-selected",
+        f"--events={events_path}",
+        box_path,
+    )
+    assert result.exit_code == 0
+    [dedup] = instances
+    assert dedup.events.closed
+
+
+@pytest.mark.parametrize("report_format", ["table", "json"])
+def test_profiling(make_box, tmp_path, report_format):
+    """Each phase is profiled to its own file, and its hottest functions reported."""
+    box_path, _ = make_box(
+        mbox,
+        [
+            MailFactory(body="Hello I am a duplicate mail."),
+            MailFactory(body="Hello I am a duplicate mail. Bigger."),
+            MailFactory(message_id="<unique@mail.nohost.com>"),
+        ],
+    )
+    profile_dir = tmp_path.joinpath("profiles")
+    result = CliRunner(mix_stderr=False).invoke(
+        mdedup,
+        [
+            "--strategy=select-smallest",
+            "--action=delete-selected",
+            f"--report-format={report_format}",
+            f"--profile={profile_dir}",
+            box_path,
+        ],
+    )
+    assert result.exit_code == 0
+
+    phases = ["load", "hash", "select", "action"]
+    assert sorted(p.name for p in profile_dir.iterdir()) == sorted(
+        f"{phase}.prof" for phase in phases
+    )
+    for profile_file in profile_dir.iterdir():
+        assert pstats.Stats(str(profile_file)).total_calls > 0
+
+    if report_format == "json":
+        hotspots = json.loads(result.stdout)["hotspots"]
+        assert list(hotspots) == phases
+        for phase_hotspots in hotspots.values():
+            assert 0 < len(phase_hotspots) <= 5
+    else:
+        assert "◼ Profiling" in result.stdout
+        assert "Phase #1 - Compute hashes" in result.stdout.split("◼ Profiling")[1]
@@ -0,0 +1,358 @@
+# Copyright Kevin Deldycke <kevin@deldycke.com> and contributors.
+# All Rights Reserved.
+#
+# This program is Free Software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+import os
+import sys
+from mailbox import Maildir, mbox
+
+import pytest
+
+from .. import Config
+from ..action import perform_action
+from ..deduplicate import Deduplicate, diff_cost, hash_mails
+from ..mailbox import NativeMaildir
+from .conftest import MailFactory, check_box
+
+
+@pytest.mark.parametrize(
+    "lines_a,lines_b,max_cost,cost",
+    [
+        ([], [], 0, 0),
+        (["a\n", "b\n"], ["a\n", "b\n"], 0, 0),
+        (["a\n", "b\n"], ["a\n", "b\n"], 10, 0),
+        (["a\n", "b\n"], ["a\n"], 10, 2),
+        (["a\n"], ["a\n", "bbbb\n"], 10, 5),
+        (["a\n", "b\n", "c\n"], ["a\n", "x\n", "c\n"], 10, 4),
+        (["a\n", "b\n", "c\n"], ["c\n", "b\n", "a\n"], 10, 8),
+        # Bound exceeded.
+        (["a\n", "b\n", "c\n"], ["a\n", "x\n", "c\n"], 3, 4),
+        (["a\n", "b\n", "c\n"], ["c\n", "b\n", "a\n"], 0, 1),
+        (["a\n"], ["a\n", "b" * 100 + "\n"], 10, 11),
+    ],
+)
+def test_diff_cost(lines_a, lines_b, max_cost, cost):
+    assert diff_cost(lines_a, lines_b, max_cost) == cost
+    assert diff_cost(lines_b, lines_a, max_cost) == cost
+
+
+def test_content_threshold(invoke, make_box):
+    """Sets are skipped if at least one pair of distinct bodies is too different."""
+    mail = MailFactory(body="Hello I am a duplicate mail.")
+    modified_mail = MailFactory(body="Hello I am a duplicate mail. Modified.")
+    box_path, box_type = make_box(Maildir, [mail, mail, mail, modified_mail])
+
+    result = invoke(
+        "--size-threshold=-1",
+        "--content-threshold=65",
+        "--strategy=select-smaller",
+        "--action=delete-selected",
+        box_path,
+    )
+    assert result.exit_code == 0
+    assert "Skip set: mails are too dissimilar in content." in result.output
+    check_box(box_path, box_type, content=[mail, mail, mail, modified_mail])
+
+    result = invoke(
+        "--size-threshold=-1",
+        "--content-threshold=66",
+        "--strategy=select-smaller",
+        "--action=delete-selected",
+        box_path,
+    )
+    assert result.exit_code == 0
+    assert "Skip set" not in result.output
+    check_box(box_path, box_type, content=[modified_mail])
+
+
+def test_size_threshold(invoke, make_box):
+    """Sets are skipped if the biggest and smallest mails are too different."""
+    small_mail = MailFactory(body="Hello I am a duplicate mail.")
+    medium_mail = MailFactory(body="Hello I am a duplicate mail. +++")
+    big_mail = MailFactory(body="Hello I am a duplicate mail. ++++++++++")
+    box_path, box_type = make_box(Maildir, [small_mail, medium_mail, big_mail])
+
+    result = invoke(
+        "--size-threshold=10",
+        "--content-threshold=-1",
+        "--strategy=select-smallest",
+        "--action=delete-selected",
+        box_path,
+    )
+    assert result.exit_code == 0
+    assert "Skip set: mails are too dissimilar in size." in result.output
+    check_box(box_path, box_type, content=[small_mail, medium_mail, big_mail])
+
+    result = invoke(
+        "--size-threshold=11",
+        "--content-threshold=-1",
+        "--strategy=select-smallest",
+        "--action=delete-selected",
+        box_path,
+    )
+    assert result.exit_code == 0
+    assert "Skip set" not in result.output
+    check_box(box_path, box_type, content=[medium_mail, big_mail])
+
+
+@pytest.mark.parametrize("action", ["copy-selected", "move-selected"])
+def test_stream_export(invoke, make_box, tmp_path, action):
+    """Streamed selection produces the same export as the gathered one."""
+    small_mail = MailFactory(body="Hello I am a duplicate mail.")
+    big_mail = MailFactory(body="Hello I am a duplicate mail. ++++")
+    unique_mail = MailFactory(message_id="<unique@mail.nohost.com>")
+
+    exports = []
+    for options in ([], ["--stream"]):
+        box_path, _ = make_box(Maildir, [small_mail, big_mail, unique_mail])
+        export = tmp_path.joinpath(f"export-{len(exports)}.mbox")
+        result = invoke(
+            *options,
+            "--strategy=select-smallest",
+            f"--action={action}",
+            f"--export={export}",
+            box_path,
+        )
+        assert result.exit_code == 0
+        exports.append(str(export))
+
+    gathered, streamed = [sorted(map(str, mbox(export))) for export in exports]
+    assert len(gathered) == 2
+    assert gathered == streamed
+
+
+@pytest.mark.parametrize("action", ["move-selected", "delete-selected"])
+def test_batched_removals(invoke, make_box, tmp_path, monkeypatch, action):
+    """Mails are removed from their sources with one batch per source."""
+    small_mail = MailFactory(body="Hello I am a duplicate mail.")
+    big_mail = MailFactory(body="Hello I am a duplicate mail. ++++")
+    unique_a = MailFactory(message_id="<a@mail.nohost.com>")
+    unique_b = MailFactory(message_id="<b@mail.nohost.com>")
+    box_a, _ = make_box(Maildir, [small_mail, unique_a])
+    box_b, _ = make_box(Maildir, [big_mail, unique_b])
+
+    batches = []
+    original_remove_batch = NativeMaildir.remove_batch
+
+    def remove_batch(self, keys, *args, **kwargs):
+        batches.append((self._path, len(keys)))
+        return original_remove_batch(self, keys, *args, **kwargs)
+
+    def remove(self, key):
+        raise AssertionError("Mail removed one by one.")
+
+    monkeypatch.setattr(NativeMaildir, "remove_batch", remove_batch)
+    monkeypatch.setattr(NativeMaildir, "remove", remove)
+
+    options = []
+    if action == "move-selected":
+        options.append(f"--export={tmp_path.joinpath('export')}")
+    result = invoke(
+        *options, "--strategy=select-smallest", f"--action={action}", box_a, box_b
+    )
+    assert result.exit_code == 0
+    assert sorted(batches) == sorted([(box_a, 2), (box_b, 1)])
+    check_box(box_a, Maildir, content=[])
+    check_box(box_b, Maildir, content=[big_mail])
+
+
+@pytest.mark.parametrize(
+    "action,export_format",
+    [
+        ("delete-selected", None),
+        ("copy-selected", "maildir"),
+        ("move-selected", "maildir"),
+        ("move-selected", "mbox"),
+    ],
+)
+def test_renamed_mails(make_box, tmp_path, action, export_format):
+    """Mails renamed by another client after hashing are still acted upon."""
+    small_mail = MailFactory(body="Hello I am a duplicate mail.")
+    big_mail = MailFactory(body="Hello I am a duplicate mail. ++++")
+    unique_mail = MailFactory(message_id="<unique@mail.nohost.com>")
+    box_path, _ = make_box(Maildir, [small_mail, big_mail, unique_mail])
+
+    options = {}
+    if export_format:
+        options = {
+            "export": tmp_path.joinpath("export"),
+            "export_format": export_format,
+        }
+    dedup = Deduplicate(Config(strategy="select-smallest", action=action, **options))
+    dedup.add_source(box_path)
+    dedup.hash_all()
+    dedup.select_all()
+
+    # Mark all mails as seen, as a mail client would.
+    [box] = dedup.sources.values()
+    for key, subpath in box._toc.items():
+        os.rename(
+            os.path.join(box_path, subpath),
+            os.path.join(box_path, "cur", f"{key}:2,S"),
+        )
+
+    perform_action(dedup)
+    dedup.close_all()
+    if action == "copy-selected":
+        assert len(Maildir(box_path)) == 3
+    else:
+        check_box(box_path, Maildir, content=[big_mail])
+    if export_format:
+        box_type = Maildir if export_format == "maildir" else mbox
+        assert len(box_type(str(options["export"]))) == 2
+
+
+@pytest.mark.parametrize("source_type", [Maildir, mbox])
+@pytest.mark.parametrize("export_format", ["maildir", "mbox"])
+def test_byte_exact_export(invoke, make_box, tmp_path, source_type, export_format):
+    """Exported mails are kept byte for byte."""
+    box_path, _ = make_box(
+        source_type,
+        [
+            MailFactory(body="Hello I am a duplicate mail."),
+            MailFactory(body="Hello I am a duplicate mail. ++++"),
+            MailFactory(message_id="<unique@mail.nohost.com>"),
+        ],
+    )
+    # Boxes might add a trailing newline to mails as part of their envelope.
+    source_box = source_type(box_path)
+    source = {source_box.get_bytes(key).rstrip(b"\n") for key in source_box.keys()}
+    export = tmp_path.joinpath("export")
+    result = invoke(
+        "--strategy=select-smallest",
+        "--action=copy-selected",
+        f"--export={export}",
+        f"--export-format={export_format}",
+        box_path,
+    )
+    assert result.exit_code == 0
+
+    export_box = (
+        Maildir(str(export)) if export_format == "maildir" else mbox(str(export))
+    )
+    exported = [export_box.get_bytes(key).rstrip(b"\n") for key in export_box.keys()]
+    assert len(exported) == 2
+    assert set(exported) <= source
+
+
+@pytest.mark.parametrize(
+    "hash_algorithm,digest_size", [("sha224", 28), ("sha1", 20), ("blake2b-128", 16)]
+)
+def test_compact_records(make_box, hash_algorithm, digest_size):
+    """Hashed mails are grouped by binary digest without retaining their content."""
+    box_path, _ = make_box(
+        Maildir,
+        [
+            MailFactory(body="Hello I am a duplicate mail."),
+            MailFactory(body="Hello I am a duplicate mail. ++++"),
+            MailFactory(message_id="<unique@mail.nohost.com>"),
+        ],
+    )
+    dedup = Deduplicate(
+        Config(strategy="select-smallest", hash_algorithm=hash_algorithm)
+    )
+    dedup.add_source(box_path)
+    dedup.hash_all()
+
+    assert sorted(map(len, dedup.mails.values())) == [1, 2]
+    for digest, records in dedup.mails.items():
+        assert isinstance(digest, bytes)
+        assert len(digest) == digest_size
+        for record in records:
+            assert record.digest == digest
+            assert record._message is None
+            assert not hasattr(record, "__dict__")
+
+    dedup.select_all()
+    assert dedup.stats["mail_selected"] == 2
+    for record in dedup.selection:
+        assert record._message is None
+    dedup.close_all()
+
+
+def test_hash_chunks_locate_mails(make_box, monkeypatch):
+    """Workers locate maildir mails from the chunk, without scanning the box."""
+    mails = [MailFactory(message_id=f"<{i}@mail.nohost.com>") for i in range(5)]
+    box_path, _ = make_box(Maildir, mails)
+    dedup = Deduplicate(Config(jobs=2))
+    dedup.add_source(box_path)
+    [(box, box_type, mail_ids, toc)] = dedup.hash_chunks()
+    assert box_type == "maildir"
+    assert toc == {mail_id: box._toc[mail_id] for mail_id in mail_ids}
+
+    def rescan(self):
+        raise AssertionError("Maildir scanned by worker.")
+
+    monkeypatch.setattr(NativeMaildir, "_refresh", rescan)
+    results, hash_bytes = hash_mails(box_type, box._path, mail_ids, dedup.conf, toc)
+    assert [uid for uid, *_ in results] == [(box._path, i) for i in mail_ids]
+    assert hash_bytes == sum(len(m.render()) for m in mails)
+    dedup.close_all()
+
+
+def test_failed_phase_timing(tmp_path):
+    """Phases are measured and their profiler stopped even if they fail."""
+    dedup = Deduplicate(Config(profile=tmp_path))
+    with pytest.raises(ValueError):
+        with dedup.timed("load", "mail_found"):
+            raise ValueError
+    assert list(dedup.timings) == ["load"]
+    assert dedup.timings["load"]["wall_time"] >= 0
+    assert tmp_path.joinpath("load.prof").is_file()
+    # Profiler is not left enabled.
+    assert sys.getprofile() is None
+
+
+@pytest.mark.parametrize(
+    "options", [{}, {"jobs": 2}, {"prefetch": 2}, {"header_only": True}]
+)
+def test_performance_metrics(make_box, options):
+    """Metrics and timings are tracked whatever the processing mode."""
+    mails = [
+        MailFactory(body="Hello I am a duplicate mail."),
+        MailFactory(body="Hello I am a duplicate mail. Bigger."),
+        MailFactory(body="Hello I am a duplicate mail. Even bigger."),
+        MailFactory(message_id="<unique@mail.nohost.com>"),
+    ]
+    box_path, _ = make_box(mbox, mails)
+    dedup = Deduplicate(Config(strategy="select-smallest", **options))
+    with dedup.timed("load", "mail_found"):
+        dedup.add_source(box_path)
+    dedup.hash_all()
+    dedup.select_all()
+    dedup.close_all()
+
+    # The box adds a trailing newline to each mail.
+    total_bytes = sum(len(m.render()) + 1 for m in mails)
+    if options.get("header_only"):
+        assert 0 < dedup.metrics["hash_bytes"] <= total_bytes
+    else:
+        assert dedup.metrics["hash_bytes"] == total_bytes
+    assert dedup.metrics["diff_comparisons"] == 3
+    assert dedup.metrics["biggest_set"] == 3
+
+    assert list(dedup.timings) == ["load", "hash", "select"]
+    assert dedup.timings["hash"]["mails"] == 4
+    assert dedup.timings["select"]["mails"] == 4
+    for timing in dedup.timings.values():
+        assert timing["wall_time"] >= 0
+        assert timing["cpu_time"] >= 0
+        assert timing["peak_rss_growth"] is None or timing["peak_rss_growth"] >= 0
+
+    report = dedup.performance_report()
+    assert "Diff comparisons" in report
+    assert "Phase #1 - Compute hashes" in report
+    assert "Peak memory growth" in report
@@ -0,0 +1,104 @@
+# Copyright Kevin Deldycke <kevin@deldycke.com> and contributors.
+# All Rights Reserved.
+#
+# This program is Free Software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+import os
+import sqlite3
+from mailbox import Maildir, mbox
+
+import pytest
+
+from .. import deduplicate
+from .conftest import MailFactory, stats_report
+
+
+@pytest.mark.parametrize("box_type", [Maildir, mbox])
+def test_incremental_runs(invoke, make_box, tmp_path, monkeypatch, box_type):
+    """Hashes are persisted in the index and reused on subsequent runs."""
+    box_path, _ = make_box(
+        box_type,
+        [
+            MailFactory(body="Hello I am a duplicate mail."),
+            MailFactory(body="Hello I am a duplicate mail."),
+            MailFactory(body="Hello I am a duplicate mail. Bigger."),
+            MailFactory(message_id="<unique@mail.nohost.com>"),
+        ],
+    )
+    index_path = tmp_path.joinpath("index.sqlite")
+
+    # Track mails read to be hashed.
+    read = []
+    original_read_mail = deduplicate.read_mail
+
+    def read_mail(box, mail_id, conf):
+        read.append(mail_id)
+        return original_read_mail(box, mail_id, conf)
+
+    monkeypatch.setattr(deduplicate, "read_mail", read_mail)
+
+    def run(*options):
+        read.clear()
+        result = invoke(
+            f"--index={index_path}",
+            *options,
+            "--strategy=select-smallest",
+            "--action=delete-selected",
+            "--dry-run",
+            box_path,
+        )
+        assert result.exit_code == 0
+        return result.output
+
+    first_run = run()
+    assert index_path.exists()
+    with sqlite3.connect(str(index_path)) as db:
+        rows = db.execute("SELECT digest, fingerprint FROM mails").fetchall()
+    assert len(rows) == 4
+    assert len({digest for digest, _ in rows}) == 2
+    assert len({fingerprint for _, fingerprint in rows}) == 1
+    assert len(read) == 4
+
+    # Indexed mails are not read again.
+    second_run = run()
+    assert "outdated entries purged" not in second_run
+    assert stats_report(second_run) == stats_report(first_run)
+    assert read == []
+
+    prefetch_run = run("--prefetch=2")
+    assert stats_report(prefetch_run) == stats_report(first_run)
+    assert read == []
+
+    # Modified mails are hashed again. Any change to a file-based box invalidates
+    # all its mails.
+    if box_type is Maildir:
+        box = Maildir(box_path, create=False)
+        modified_id = next(iter(box.keys()))
+        modified_path = os.path.join(box_path, box._lookup(modified_id))
+        expected_reads = [modified_id]
+    else:
+        modified_path = box_path
+        expected_reads = list(range(4))
+    with open(modified_path, "ab") as modified:
+        modified.write(b"Edited.\n")
+    run()
+    assert sorted(read) == sorted(expected_reads)
+    # Their new hashes are indexed in turn.
+    run()
+    assert read == []
+
+    # Changing hashed headers invalidates the whole index.
+    third_run = run("--hash-header=message-id")
+    assert "4 outdated entries purged from the index." in third_run
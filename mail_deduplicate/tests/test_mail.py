@@ -15,8 +15,13 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
+import os
 from mailbox import Maildir, mbox
 
+import pytest
+
+from ..mail import DedupMail, header_normalizer, parse_date
+from ..mailbox import open_box
 from .conftest import MailFactory, check_box, skip_windows
 
 """ Some invalid dates are not supported on Windows as they produce negative
@@ -98,3 +103,64 @@ def test_invalid_date_parsing_dedup(invoke, make_box):
             invalid_date_mail_1,
         ],
     )
+
+
+@pytest.mark.parametrize(
+    "header_id,value,expected",
+    (
+        ("subject", "  Hello\n\t world  ", "Hello world"),
+        ("subject", "Re: [list-a] [list_b] Hello", "Hello"),
+        ("subject", "[list-a] Re: [list-b] Hello", "Hello"),
+        ("subject", "Hello [world]", "Hello [world]"),
+        ("content-type", 'text/plain; charset="us-ascii"', "text/plain"),
+        ("content-type", "text/plain", "text/plain"),
+        ("date", "Thu, 13 Dec 2018 23:30:00 -0100", "2018-12-14"),
+        ("date", "not a date", "not a date"),
+        ("to", "<foo@example.com>", "foo@example.com"),
+        (
+            "to",
+            "<foo@example.com>, <bar@example.com>",
+            "<foo@example.com>, <bar@example.com>",
+        ),
+        ("message-id", "<1234@example.com>", "1234@example.com"),
+        ("from", "<foo@example.com>", "<foo@example.com>"),
+        ("x-custom", b"  raw  bytes ", "raw bytes"),
+    ),
+)
+def test_header_normalization(header_id, value, expected):
+    normalizer = header_normalizer((header_id,))
+    assert normalizer.normalize(header_id, value) == expected
+    assert DedupMail.normalize_header_value(header_id, value) == expected
+
+
+def test_date_parsing_cache():
+    parse_date.cache_clear()
+    value = "Thu, 13 Dec 2018 23:30:00 -0100"
+    assert parse_date(value) == ("2018-12-14", 1544747400)
+    assert parse_date(value) == ("2018-12-14", 1544747400)
+    assert parse_date("not a date") == (None, None)
+    info = parse_date.cache_info()
+    assert info.hits == 1
+    assert info.misses == 2
+
+
+@pytest.mark.parametrize("box_type", (Maildir, mbox))
+def test_path_resolution(make_box, box_type):
+    """Location of mails is derived from their box, without opening any file."""
+    box_path, _ = make_box(box_type, [MailFactory(), MailFactory()])
+    [box] = open_box(box_path, box_type.__name__.lower())
+    mails = list(box.iteritems())
+
+    def no_opening(mail_id):
+        raise AssertionError("Mail file opened.")
+
+    box.get_file = no_opening
+    for mail_id, mail in mails:
+        mail.add_box_metadata(box, mail_id)
+        if box_type is Maildir:
+            assert os.path.dirname(mail.path) == os.path.join(box_path, "new")
+            assert os.path.basename(mail.path).startswith(mail_id)
+        else:
+            assert mail.path == box_path
+        assert os.path.isfile(mail.path)
+    box.close()
@@ -15,8 +15,31 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
+import contextlib
+import mailbox
+import os
+from functools import partial
+
 import pytest
 
+from .. import Config
+from .. import mailbox as dedup_mailbox
+from ..deduplicate import Deduplicate
+from ..mail import mail_stat
+from ..mailbox import (
+    BOX_TYPES,
+    BatchWriter,
+    NativeMaildir,
+    NativeMbox,
+    NativeMMDF,
+    box_type_id,
+    open_box,
+    open_subfolders,
+    read_headers,
+    remove_batch,
+)
+from .conftest import MailFactory
+
 
 @pytest.mark.parametrize("source", ["./dummy_maildir/", "./__init__.py"])
 def test_nonexistent_path(invoke, source):
@@ -31,3 +54,442 @@ def test_invalid_maildir_structure(invoke):
     assert "Phase #0" in result.output
     assert "Opening " in result.output
     assert "Missing sub-directory" in str(result.exc_info[1])
+
+
+def test_native_maildir(make_box):
+    box_path, _ = make_box(mailbox.Maildir, [MailFactory(), MailFactory()])
+    # Move one mail to cur/ and add noise the reader must skip.
+    stdlib_box = mailbox.Maildir(box_path, create=False)
+    mail_id = next(stdlib_box.iterkeys())
+    msg = stdlib_box[mail_id]
+    msg.set_subdir("cur")
+    stdlib_box[mail_id] = msg
+    os.mkdir(os.path.join(box_path, "cur", "subdir"))
+    stdlib_box.add_folder("sub")
+
+    [box, subfolder] = open_box(box_path, "maildir")
+    assert isinstance(box, NativeMaildir)
+    assert isinstance(subfolder, NativeMaildir)
+    assert box_type_id(box) == "maildir"
+
+    assert sorted(box.iterkeys()) == sorted(stdlib_box.iterkeys())
+    assert box._toc == stdlib_box._toc
+    for mail_id, subpath in box._toc.items():
+        stat = os.stat(os.path.join(box_path, subpath))
+        assert mail_stat(box, mail_id) == (
+            stat.st_mtime_ns,
+            stat.st_ctime_ns,
+            stat.st_size,
+        )
+    box.close()
+    subfolder.close()
+
+
+def test_native_maildir_vanished_entries(make_box, monkeypatch):
+    """Entries disappearing while the maildir is scanned are skipped."""
+    box_path, _ = make_box(mailbox.Maildir, [MailFactory(), MailFactory()])
+    [moved, kept] = sorted(mailbox.Maildir(box_path, create=False).iterkeys())
+    os.symlink(
+        os.path.join(box_path, "tmp", "missing"),
+        os.path.join(box_path, "cur", "dangling"),
+    )
+
+    # Simulate a mail renamed by another process between listing and stat.
+    original_scandir = os.scandir
+
+    def scandir(path):
+        entries = list(original_scandir(path))
+        for entry in entries:
+            if entry.name.startswith(moved):
+                os.rename(entry.path, os.path.join(box_path, "tmp", entry.name))
+        return contextlib.closing(entry for entry in entries)
+
+    monkeypatch.setattr(dedup_mailbox.os, "scandir", scandir)
+    box = NativeMaildir(box_path, create=False)
+    box.refresh_toc()
+    assert list(box._toc) == [kept]
+    assert list(box._stats) == [kept]
+
+
+def test_native_maildir_lookups(make_box, monkeypatch):
+    """Mails are located from the table of contents without stating their file, and
+    are found again once renamed by another client."""
+    mails = [MailFactory(message_id=f"<{i}@mail.nohost.com>") for i in range(6)]
+    box_path, _ = make_box(mailbox.Maildir, mails)
+    dedup = Deduplicate(Config())
+    dedup.add_source(box_path)
+    [box] = dedup.sources.values()
+
+    stated = []
+    original_stat = os.stat
+
+    def stat(path, *args, **kwargs):
+        stated.append(os.path.basename(path))
+        return original_stat(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, "stat", stat)
+    dedup.hash_all()
+    # Only sub-folders are checked for modifications.
+    assert set(stated) <= {"cur", "new"}
+    monkeypatch.setattr(os, "stat", original_stat)
+
+    renamed, removed = sorted(box.iterkeys())[:2]
+    content = box.get_bytes(renamed)
+    for key in (renamed, removed):
+        os.rename(
+            os.path.join(box_path, box._toc[key]),
+            os.path.join(box_path, "cur", f"{key}:2,S"),
+        )
+    assert box.get_bytes(renamed) == content
+    assert box.get_message(renamed).get_flags() == "S"
+    box.remove(removed)
+    assert removed not in box.keys()
+    dedup.close_all()
+
+
+@pytest.mark.parametrize("threads", (1, 2, 16))
+def test_subfolders_order(make_box, threads):
+    box_path, _ = make_box(mailbox.Maildir, [MailFactory()])
+    stdlib_box = mailbox.Maildir(box_path, create=False)
+    for folder_id in ("b", "a", "c"):
+        folder = stdlib_box.add_folder(folder_id)
+        for subfolder_id in ("y", "x"):
+            folder.add_folder(subfolder_id)
+
+    # Expected depth-first order, as listed by the filesystem.
+    def walk(folder):
+        yield folder._path
+        for folder_id in folder.list_folders():
+            yield from walk(folder.get_folder(folder_id))
+
+    expected = list(walk(stdlib_box))
+    assert len(expected) == 10
+
+    boxes = open_subfolders(BOX_TYPES["maildir"](box_path), False, threads=threads)
+    assert [box._path for box in boxes] == expected
+    for box in boxes:
+        box.close()
+
+
+@pytest.mark.parametrize(
+    "stdlib_klass,native_klass",
+    ((mailbox.mbox, NativeMbox), (mailbox.MMDF, NativeMMDF)),
+)
+@pytest.mark.parametrize(
+    "content",
+    (
+        b"",
+        b"From a@b Sat Jan  3 01:05:34 1996\nSubject: 1\n\nbody\n",
+        b"preamble\nFrom a\nSubject: 1\n\nFrom here\n\nFrom b\nSubject: 2\n \nb\n",
+        b"From a\nSubject: 1\nFrom b\n\nFrom c\n\n\n",
+        b"\001\001\001\001\nFrom a\nSubject: 1\n\nbody\n\001\001\001\001\n"
+        b"junk\n\001\001\001\001\nFrom b\nSubject: 2\n\nbody\n",
+        b"\001\001\001\001\nFrom a\nSubject: 1\n\nno end",
+    ),
+)
+def test_mapped_boxes(tmp_path, stdlib_klass, native_klass, content):
+    """Memory-mapped readers index and read messages the same way the standard
+    library does."""
+    box_path = tmp_path.joinpath("box")
+    box_path.write_bytes(content)
+    stdlib_box = stdlib_klass(str(box_path), create=False)
+    native_box = native_klass(str(box_path), create=False)
+
+    assert list(native_box.iterkeys()) == list(stdlib_box.iterkeys())
+    assert native_box._toc == stdlib_box._toc
+    for mail_id in stdlib_box.iterkeys():
+        assert native_box.get_bytes(mail_id) == stdlib_box.get_bytes(mail_id)
+        assert native_box.get_bytes(mail_id, True) == stdlib_box.get_bytes(
+            mail_id, True
+        )
+        headers = read_headers(native_box, mail_id)
+        assert headers == read_headers(stdlib_box, mail_id)
+        # Headers stop at the first empty line, or span the whole message.
+        assert headers.endswith(b"\n\n") or headers in (
+            b"\n",
+            native_box.get_bytes(mail_id),
+        )
+    native_box.close()
+    stdlib_box.close()
+
+
+@pytest.mark.parametrize("box_type", ("maildir", "mbox", "mmdf"))
+@pytest.mark.parametrize("newline", (b"\n", b"\r\n"))
+def test_read_headers(tmp_path, box_type, newline):
+    """Headers are read up to the first empty line, as the ``email`` parser does.
+    Lines made of whitespaces only are folded into headers."""
+    content = newline.join(
+        [
+            b"From: a@example.com",
+            b"To: b@example.com",
+            b"Subject: Folded",
+            b" \t",
+            b"Message-ID: <1@example.com>",
+            b"Date: Sat, 3 Jan 1996 01:05:34 +0000",
+            b"X-Extra: 1",
+            b"",
+            b"Body",
+            b"",
+            b"Trailer: not a header",
+            b"",
+        ]
+    )
+    box_path = str(tmp_path.joinpath("box"))
+    box = BOX_TYPES[box_type](box_path, create=True)
+    mail_id = box.add(content)
+    box.close()
+
+    box = BOX_TYPES[box_type](box_path)
+    headers = read_headers(box, mail_id)
+    assert headers.endswith(newline + newline)
+    full = box._factory(box.get_bytes(mail_id))
+    assert len(full) == 6
+    assert box._factory(headers).items() == full.items()
+    box.close()
+
+
+@pytest.mark.parametrize(
+    "stdlib_klass,native_klass",
+    ((mailbox.mbox, NativeMbox), (mailbox.MMDF, NativeMMDF)),
+)
+def test_toc_cache(tmp_path, monkeypatch, stdlib_klass, native_klass):
+    monkeypatch.setattr(dedup_mailbox, "TOC_CACHE_MIN_SIZE", 0)
+    box_path = str(tmp_path.joinpath("box"))
+    cache_path = f"{box_path}{dedup_mailbox.TOC_CACHE_SUFFIX}"
+
+    stdlib_box = stdlib_klass(box_path)
+    for i in range(3):
+        stdlib_box.add(f"Subject: {i}\n\nBody {i}\n")
+    stdlib_box.close()
+
+    scans = []
+    original_scan = native_klass._scan
+
+    def tracked_scan(data, length, pos=0):
+        scans.append(pos)
+        return original_scan(data, length, pos)
+
+    monkeypatch.setattr(native_klass, "_scan", staticmethod(tracked_scan))
+
+    def check_toc():
+        native_box = native_klass(box_path, create=False)
+        stdlib_box = stdlib_klass(box_path, create=False)
+        assert native_box.keys() == stdlib_box.keys()
+        assert native_box._toc == stdlib_box._toc
+        native_box.close()
+        stdlib_box.close()
+
+    # First opening scans the whole box and creates the cache.
+    check_toc()
+    assert scans == [0]
+    assert os.path.isfile(cache_path)
+
+    # Unchanged box is not scanned again.
+    check_toc()
+    assert scans == [0]
+
+    # Appended box is only scanned from its last message.
+    stdlib_box = stdlib_klass(box_path)
+    last_start = stdlib_box._lookup(2)[0]
+    stdlib_box.add("Subject: 3\n\nBody 3\n")
+    stdlib_box.close()
+    check_toc()
+    assert len(scans) == 2
+    assert 0 < scans[1] <= last_start
+
+    # Cache is updated when the box is rewritten, so no scan is needed.
+    native_box = native_klass(box_path, create=False)
+    native_box.lock()
+    native_box.remove(1)
+    native_box.close()
+    check_toc()
+    assert len(scans) == 2
+
+    # Box modified in place is fully scanned again.
+    with open(box_path, "r+b") as box_file:
+        box_file.write(b"X")
+    check_toc()
+    assert scans[-1] == 0
+
+
+@pytest.mark.parametrize(
+    "stdlib_klass,native_klass",
+    (
+        (mailbox.mbox, NativeMbox),
+        (mailbox.MMDF, NativeMMDF),
+        (mailbox.Maildir, NativeMaildir),
+    ),
+)
+def test_batch_writer(tmp_path, stdlib_klass, native_klass):
+    """Messages added by batches are the same as messages added one by one."""
+    messages = []
+    for i in range(5):
+        message = mailbox.mboxMessage(f"Subject: {i}\n\nFrom the body {i}\n")
+        message.set_from("MAILER-DAEMON Sat Jan  3 01:05:34 1996")
+        messages.append(message)
+
+    stdlib_box = stdlib_klass(str(tmp_path.joinpath("stdlib")))
+    for message in messages:
+        stdlib_box.add(message)
+
+    written = []
+    native_box = native_klass(str(tmp_path.joinpath("native")))
+    writer = BatchWriter(native_box, batch_size=2)
+    for i, message in enumerate(messages):
+        writer.add(message, partial(written.append, i))
+        # Callbacks are only called once their batch is written.
+        assert written == list(range(i + 1 - (i + 1) % 2))
+    writer.close()
+    assert written == list(range(5))
+
+    native_box = native_klass(str(tmp_path.joinpath("native")), create=False)
+    assert len(native_box) == len(stdlib_box) == 5
+    assert sorted(map(bytes, native_box.itervalues())) == sorted(
+        map(bytes, stdlib_box.itervalues())
+    )
+    if native_klass is not NativeMaildir:
+        assert native_box._toc == stdlib_box._toc
+        stdlib_box.close()
+        assert (
+            tmp_path.joinpath("native").read_bytes()
+            == tmp_path.joinpath("stdlib").read_bytes()
+        )
+    else:
+        assert not os.listdir(tmp_path.joinpath("native", "tmp"))
+    native_box.close()
+
+
+def test_batch_writer_bytes(tmp_path):
+    """Batches are written once their raw messages exceed the size limit."""
+    written = []
+    box = NativeMbox(str(tmp_path.joinpath("box")))
+    writer = BatchWriter(box, batch_size=100, batch_bytes=100)
+    for i in range(5):
+        writer.add(f"Subject: {i}\n\n{'x' * 40}\n".encode(), partial(written.append, i))
+        # Callbacks are only called once their batch is written.
+        assert written == list(range(i + 1 - (i + 1) % 2))
+    assert writer.pending_bytes < 100
+    writer.close()
+    assert written == list(range(5))
+
+
+@pytest.mark.parametrize(
+    "stdlib_klass,native_klass",
+    (
+        (mailbox.mbox, NativeMbox),
+        (mailbox.MMDF, NativeMMDF),
+        (mailbox.Maildir, NativeMaildir),
+    ),
+)
+def test_remove_batch(tmp_path, stdlib_klass, native_klass):
+    """Batch removal leaves boxes in the same state as one by one removal."""
+    box_paths = []
+    for name in ("stdlib", "native"):
+        box_path = str(tmp_path.joinpath(name))
+        box = stdlib_klass(box_path)
+        for i in range(6):
+            message = mailbox.mboxMessage(f"Subject: {i}\n\nBody {i}\n")
+            message.set_from("MAILER-DAEMON Sat Jan  3 01:05:34 1996")
+            box.add(message)
+        box.close()
+        box_paths.append(box_path)
+
+    def removed_keys(box):
+        return [key for key in box.iterkeys() if int(box[key]["subject"]) % 2]
+
+    stdlib_box = stdlib_klass(box_paths[0], create=False)
+    stdlib_box.lock()
+    for key in removed_keys(stdlib_box):
+        stdlib_box.remove(key)
+    stdlib_box.close()
+
+    native_box = native_klass(box_paths[1], create=False)
+    native_box.lock()
+    remove_batch(native_box, removed_keys(native_box))
+    assert len(native_box) == 3
+    native_box.close()
+
+    stdlib_box = stdlib_klass(box_paths[0], create=False)
+    native_box = native_klass(box_paths[1], create=False)
+    assert sorted(map(bytes, native_box.itervalues())) == sorted(
+        map(bytes, stdlib_box.itervalues())
+    )
+    if native_klass is not NativeMaildir:
+        assert native_box._toc == stdlib_box._toc
+        assert open(box_paths[0], "rb").read() == open(box_paths[1], "rb").read()
+    native_box.close()
+    stdlib_box.close()
+
+
+def test_clone_file_fallback(tmp_path, monkeypatch):
+    """Files are copied without any ioctl on platforms not supporting clones."""
+    monkeypatch.setattr(dedup_mailbox, "FICLONE", None)
+    if dedup_mailbox.fcntl:
+
+        def ioctl(*args):
+            raise AssertionError("ioctl called.")
+
+        monkeypatch.setattr(dedup_mailbox.fcntl, "ioctl", ioctl)
+    source = tmp_path.joinpath("source")
+    source.write_bytes(b"Subject: 1\n\nBody\n")
+    with tmp_path.joinpath("target").open("wb") as target:
+        dedup_mailbox.clone_file(str(source), target)
+    assert tmp_path.joinpath("target").read_bytes() == source.read_bytes()
+
+
+def no_hard_links(src, dst):
+    raise PermissionError(1, "Operation not permitted")
+
+
+def test_add_batch_without_hard_links(tmp_path, monkeypatch):
+    """Messages are renamed from tmp/ on filesystems not supporting hard links."""
+    monkeypatch.setattr(os, "link", no_hard_links)
+    box = NativeMaildir(str(tmp_path.joinpath("box")))
+    keys = box.add_batch([f"Subject: {i}\n\nBody {i}\n" for i in range(3)])
+    assert sorted(box.iterkeys()) == sorted(keys)
+    assert sorted(box[key]["subject"] for key in keys) == ["0", "1", "2"]
+    assert not os.listdir(os.path.join(box._path, "tmp"))
+
+
+@pytest.mark.parametrize("hard_link", (True, False, None))
+def test_add_files(tmp_path, monkeypatch, hard_link):
+    """Maildir files are added byte for byte, keeping their flags.
+
+    ``hard_link`` is ``None`` for filesystems not supporting hard links at all."""
+    source = NativeMaildir(str(tmp_path.joinpath("source")))
+    message = mailbox.MaildirMessage("Subject: 1\n\nBody\n")
+    message.set_subdir("cur")
+    message.set_flags("S")
+    source.add(message)
+    source.add("Subject: 2\n\nBody\n")
+    source.refresh_toc()
+    paths = [os.path.join(source._path, subpath) for subpath in source._toc.values()]
+    assert len(paths) == 2
+
+    if hard_link is None:
+        monkeypatch.setattr(os, "link", no_hard_links)
+    elif not hard_link:
+        original_link = os.link
+
+        def cross_device_link(src, dst):
+            if src in paths:
+                raise OSError(18, "Invalid cross-device link")
+            return original_link(src, dst)
+
+        monkeypatch.setattr(os, "link", cross_device_link)
+
+    export = NativeMaildir(str(tmp_path.joinpath("export")))
+    keys = export.add_files([(source, key) for key in source._toc])
+    export = NativeMaildir(str(tmp_path.joinpath("export")), create=False)
+    assert sorted(export.iterkeys()) == sorted(keys)
+    assert not os.listdir(os.path.join(export._path, "tmp"))
+
+    for path, key in zip(paths, keys):
+        exported = os.path.join(export._path, export._toc[key])
+        with open(path, "rb") as original, open(exported, "rb") as copy:
+            assert original.read() == copy.read()
+        # Sub-folder and flags are kept.
+        assert os.path.dirname(exported).endswith(os.path.dirname(path)[-3:])
+        assert exported.partition(export.colon)[2] == path.partition(source.colon)[2]
+        assert os.stat(exported).st_mtime_ns == os.stat(path).st_mtime_ns
+        assert os.path.samefile(exported, path) == bool(hard_link)